@@ -0,0 +1,228 @@
+#!/usr/local/bin/python3
+
+# Times each stage of generate_tiles, from enumerating layouts through to draw_tiles writing a deck,
+# across palette sizes and resolutions. Results are written as JSON so that a later run can be compared
+# against them:
+#   ./bench_generate_tiles.py --output baseline.json
+#   ./bench_generate_tiles.py --baseline baseline.json --threshold 1.2
+import argparse
+import contextlib
+import copy
+import io
+import json
+import platform
+import sys
+import tempfile
+import time
+from enum import Enum
+from itertools import product
+from typing import Callable, Dict, List
+
+import PIL
+
+from generate_tiles import *
+
+PALETTE_SIZES = [4, 8, 16]
+RESOLUTIONS = [300, 1200]
+
+# Color only has 10 members, so larger palettes are synthesized; generation and drawing only ever read
+# .value off a color
+BenchColor = Enum('BenchColor', {f'C{i}': (i * 15, 255 - i * 15, (i * 37) % 256, 255) for i in range(16)})
+
+BENCH_LAYOUTS = dedupe_rotational_symmetry(filter_illegal(get_all_products())) + [
+    (ShapeType.NUB, ShapeType.NUB, ShapeType.BLANK, ShapeType.BLANK),
+]
+
+
+def generate_colored_linear(pattern: TilePattern, colors: List) -> List[PathTile]:
+    # the original implementation: every candidate is compared against every tile kept so far,
+    # sorting both shape lists on each comparison
+    def sort_key(s):
+        return s.shape_type.value, s.color.value
+
+    colored_tiles = []
+    for tile_shapes_colors_tuples in product(*[product([s], colors) for s in pattern.shapes]):
+        colored_shapes = []
+        for shape, color in tile_shapes_colors_tuples:
+            shape = copy.copy(shape)
+            shape.set_color(color)
+            colored_shapes.append(shape)
+
+        new_shapes = sorted(colored_shapes, key=sort_key)
+        if not any(sorted(t, key=sort_key) == new_shapes for t in colored_tiles):
+            colored_tiles.append(colored_shapes)
+    return [PathTile(shapes) for shapes in colored_tiles]
+
+
+def time_call(func: Callable, repeat: int, number: int = 1) -> float:
+    # the best of repeat runs, per call
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_enumeration(repeat: int) -> Dict[str, float]:
+    products = get_all_products()
+    filtered = filter_illegal(products)
+    layouts = dedupe_rotational_symmetry(filtered)
+    return {
+        "get_all_products": time_call(get_all_products, repeat, 100),
+        "get_all_products+filter_illegal": time_call(lambda: filter_illegal(get_all_products()), repeat, 100),
+        "filter_illegal_vectorized": time_call(lambda: filter_illegal_vectorized(products), repeat, 100),
+        "dedupe_rotational_symmetry": time_call(lambda: dedupe_rotational_symmetry(filtered), repeat, 100),
+        "construct_layouts": time_call(construct_layouts, repeat, 100),
+        "construct_layouts[all shape types]": time_call(lambda: construct_layouts(list(ShapeType)), repeat, 100),
+        "TilePattern.__init__": time_call(lambda: [TilePattern(layout) for layout in layouts], repeat, 100),
+    }
+
+
+def bench_generate_colored(palette_sizes: List[int], repeat: int) -> Dict[str, float]:
+    patterns = [TilePattern(layout) for layout in BENCH_LAYOUTS]
+    results = {}
+    for size in palette_sizes:
+        colors = list(BenchColor)[:size]
+        results[f'generate_colored[colors={size}]'] = time_call(
+            lambda: [list(p.generate_colored(colors)) for p in patterns], repeat)
+    return results
+
+
+def bench_shape_draw(resolutions: List[int], repeat: int) -> Dict[str, float]:
+    # one of each shape, drawn as vectors and filled from stamps
+    shapes = [
+        Corner([top_pt, right_pt], PX_PER_TILE),
+        Line([top_pt, bot_pt], PX_PER_TILE),
+        Tee([top_pt, right_pt, bot_pt], PX_PER_TILE),
+        Nub(top_pt, PX_PER_TILE),
+    ]
+    results = {}
+    for px in resolutions:
+        background = Image.new('RGBA', (px, px), Color.LIGHT_GREY.value)
+        drawer = ImageDraw.Draw(background)
+        for shape in shapes:
+            def stamped():
+                for mask, (x, y) in shape.stamp(px):
+                    background.paste(shape.color.value, (x, y, x + mask.width, y + mask.height), mask)
+
+            name = shape.shape_type.value
+            results[f'draw[{name}, px={px}]'] = time_call(lambda: shape.draw(drawer, canvas_px=px), repeat, 20)
+            results[f'stamp[{name}, px={px}]'] = time_call(stamped, repeat, 20)
+    return results
+
+
+def bench_rasterize(resolutions: List[int], repeat: int) -> Dict[str, float]:
+    # the whole default deck's path tiles, one at a time and as a batch
+    tiles = list(gen_path_tiles(enumerate_layouts(), DEFAULT_COLORS))
+    results = {}
+    for px in resolutions:
+        for supersample in (1, 4):
+            settings = RenderSettings(px_per_tile=px, supersample=supersample)
+            name = f'px={px}, supersample={supersample}'
+            results[f'render_tile[{name}]'] = time_call(lambda: [render_tile(t, settings) for t in tiles], repeat)
+            results[f'rasterize_tiles[{name}]'] = time_call(
+                lambda: [rasterize_tiles(tiles[c:c + RASTER_BATCH_SIZE], settings)
+                         for c in range(0, len(tiles), RASTER_BATCH_SIZE)], repeat)
+    return results
+
+
+def bench_draw_tiles(palette_sizes: List[int], resolutions: List[int], repeat: int) -> Dict[str, float]:
+    layouts = dedupe_rotational_symmetry(filter_illegal(get_all_products()))
+    results = {}
+    for size in palette_sizes:
+        colors = list(BenchColor)[:size]
+        for px in resolutions:
+            settings = RenderSettings(px_per_tile=px)
+
+            def build():
+                tiles = chain(gen_path_tiles(layouts, colors), gen_novelty_tiles(size, True))
+                with tempfile.TemporaryDirectory() as out_dir, contextlib.redirect_stdout(io.StringIO()):
+                    draw_tiles(tiles, out_dir, settings=settings)
+
+            results[f'draw_tiles[colors={size}, px={px}]'] = time_call(build, repeat)
+    return results
+
+
+def run(palette_sizes: List[int], resolutions: List[int], repeat: int) -> dict:
+    results = {}
+    results.update(bench_enumeration(repeat))
+    results.update(bench_generate_colored(palette_sizes, repeat))
+    results.update(bench_shape_draw(resolutions, repeat))
+    results.update(bench_rasterize(resolutions, repeat))
+    results.update(bench_draw_tiles(palette_sizes, resolutions, repeat))
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[str]:
+    # names of the benchmarks that got slower than threshold times their baseline
+    regressions = []
+    for name, seconds in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        ratio = seconds / before
+        print(f'{name:<40} {before * 1e3:>10.3f}ms {seconds * 1e3:>10.3f}ms {ratio:>6.2f}x')
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def compare_dedupe(palette_sizes: List[int]):
+    # generate_colored against the generate-then-dedupe implementation it replaced
+    patterns = [TilePattern(layout) for layout in BENCH_LAYOUTS]
+    print(f'{"colors":>6} {"tiles":>6} {"linear (s)":>11} {"current (s)":>11} {"speedup":>8}')
+    for size in palette_sizes:
+        colors = list(BenchColor)[:size]
+        tile_count = sum(len(list(p.generate_colored(colors))) for p in patterns)
+        linear = time_call(lambda: [generate_colored_linear(p, colors) for p in patterns], 1)
+        current = time_call(lambda: [list(p.generate_colored(colors)) for p in patterns], 1)
+        print(f'{size:>6} {tile_count:>6} {linear:>11.4f} {current:>11.4f} {linear / current:>7.1f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tile generation and rendering")
+    parser.add_argument("--colors", type=int, nargs="+", default=PALETTE_SIZES, help="palette sizes")
+    parser.add_argument("--px", type=int, nargs="+", default=RESOLUTIONS, help="tile resolutions")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the best is kept")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results previously written with --output")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="slowdown against the baseline that counts as a regression")
+    parser.add_argument("--compare-dedupe", action="store_true",
+                        help="only time generate_colored against the old linear-scan dedup")
+    args = parser.parse_args()
+
+    if args.compare_dedupe:
+        compare_dedupe(args.colors)
+        return
+
+    current = run(args.colors, args.px, args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+    else:
+        for name, seconds in current["results"].items():
+            print(f'{name:<40} {seconds * 1e3:>10.3f}ms')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), current, args.threshold)
+        if regressions:
+            print(f'regressed: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+# Which tiles of a deck can sit next to which, for the game engine and puzzle checker to answer placement
+# queries without looking at any images. generate_tiles writes it next to each deck and this module reads
+# it back without needing anything from generate_tiles:
+#   index = EdgeIndex("tilesA/edges.bin")
+#   index.neighbors(12, side=1)   # every (tile id, rotation) that can go to the right of tile 12
+# Sides are numbered top first and clockwise. What reaches a side is packed into a one byte edge key: the
+# shape type's id + 1 above EDGE_COLOR_BITS of color index, where color index 0 means uncolored (a blank
+# side) and key 0 means the tile has no connectors at all. Shape types and colors get ids in the order
+# they're first seen, and are listed in the file by name and RGBA value.
+# All little endian, the file is a header of magic, version, shape type names length, color count, tile
+# count and entry count ("<4sHHHII"), then
+#   shape types  their names, NUL separated
+#   colors       color count RGBA values
+#   connectors   4 uint32 per tile, its packed connectors in each rotation (0 for tiles without paths)
+#   key table    for each of the 256 edge keys, the uint32 offset and count of its entries
+#   entries      uint32 tile id << 2 | side, for every side of every tile, grouped by the side's key
+import os
+import struct
+import sys
+from array import array
+from collections import defaultdict
+from typing import Iterable, List, Tuple
+
+EDGE_INDEX_NAME = "edges.bin"
+EDGE_INDEX_MAGIC = b"TEDG"
+EDGE_INDEX_VERSION = 2
+EDGE_INDEX_HEADER = "<4sHHHII"
+# so 31 colors and 7 shape types fit in a byte
+EDGE_COLOR_BITS = 5
+EDGE_COLOR_MASK = (1 << EDGE_COLOR_BITS) - 1
+EDGE_TYPE_COUNT = (1 << (8 - EDGE_COLOR_BITS)) - 1
+
+
+def edge_key(type_id: int, color_index: int) -> int:
+    return (type_id + 1) << EDGE_COLOR_BITS | color_index
+
+
+# With the tile turned clockwise by rotation quarter turns, side s shows what was on side s - rotation.
+# Packs the four edge keys into an int with the top side in the most significant byte.
+def pack_connectors(keys: List[int], rotation: int = 0) -> int:
+    packed = 0
+    for side in range(len(keys)):
+        packed = packed << 8 | keys[(side - rotation) % len(keys)]
+    return packed
+
+
+def _value(x):
+    # enum members (e.g. generate_tiles' ShapeType and Color) stand for their values
+    return getattr(x, "value", x)
+
+
+class EdgeIndexBuilder:
+    # Collects the side connectors of a deck's tiles in tile id order, and writes them out as an index
+    # EdgeIndex can read
+    def __init__(self):
+        self.shape_types = {}
+        self.colors = {}
+        self.keys = []
+
+    # sides holds what reaches each side as a (shape type name, RGBA color or None) pair, or is None
+    # for a tile without paths
+    def add(self, sides: Iterable[Tuple[str, Tuple[int, int, int, int]]] = None):
+        if sides is None:
+            self.keys.append(None)
+            return
+        keys = []
+        for shape_type, color in sides:
+            type_id = self.shape_types.setdefault(shape_type, len(self.shape_types))
+            if type_id >= EDGE_TYPE_COUNT:
+                raise ValueError(f"an edge index can't hold more than {EDGE_TYPE_COUNT} shape types")
+            color_index = 0
+            if color is not None:
+                color_index = self.colors.setdefault(tuple(color), len(self.colors) + 1)
+                if color_index > EDGE_COLOR_MASK:
+                    raise ValueError(f"an edge index can't hold more than {EDGE_COLOR_MASK} colors")
+            keys.append(edge_key(type_id, color_index))
+        self.keys.append(keys)
+
+    def write(self, path: str):
+        connectors = array('I')
+        entries_by_key = defaultdict(list)
+        for tile_id, keys in enumerate(self.keys):
+            if keys is None:
+                connectors.extend([0] * 4)
+                continue
+            connectors.extend(pack_connectors(keys, rotation) for rotation in range(4))
+            for side, key in enumerate(keys):
+                entries_by_key[key].append(tile_id << 2 | side)
+
+        table = array('I')
+        entries = array('I')
+        for key in range(256):
+            table.extend([len(entries), len(entries_by_key[key])])
+            entries.extend(entries_by_key[key])
+        if sys.byteorder == "big":
+            for a in (connectors, table, entries):
+                a.byteswap()
+
+        names = "\0".join(self.shape_types).encode()
+        header = struct.pack(EDGE_INDEX_HEADER, EDGE_INDEX_MAGIC, EDGE_INDEX_VERSION, len(names), len(self.colors),
+                             len(self.keys), len(entries))
+        colors = b"".join(bytes(color) for color in self.colors)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(header + names + colors + connectors.tobytes() + table.tobytes() + entries.tobytes())
+        os.replace(tmp, path)
+
+
+class EdgeIndex:
+    # Answers which tiles can go next to which from a file EdgeIndexBuilder wrote. Tile ids are positions
+    # in the deck, as in the image names. Two sides fit together when their edge keys have the same
+    # color, whatever shape ends there: a red corner meets a red line, and a blank side meets a blank.
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, names_length, color_count, self.tile_count, entry_count = \
+            struct.unpack_from(EDGE_INDEX_HEADER, data)
+        if magic != EDGE_INDEX_MAGIC or version != EDGE_INDEX_VERSION:
+            raise ValueError(f'{path} isn\'t a version {EDGE_INDEX_VERSION} edge index')
+        offset = struct.calcsize(EDGE_INDEX_HEADER)
+        names = data[offset:offset + names_length].decode()
+        self.shape_types = names.split("\0") if names else []
+        offset += names_length
+        self.colors = [tuple(data[offset + 4 * i:offset + 4 * i + 4]) for i in range(color_count)]
+        offset += 4 * color_count
+
+        def read(count: int) -> array:
+            nonlocal offset
+            a = array('I', data[offset:offset + 4 * count])
+            if sys.byteorder == "big":
+                a.byteswap()
+            offset += 4 * count
+            return a
+
+        self._connectors = read(4 * self.tile_count)
+        self._table = read(2 * 256)
+        self._entries = read(entry_count)
+
+    # 0 for None, otherwise 1 + the color's position in colors; color is an RGBA value or a Color member
+    def color_index(self, color=None) -> int:
+        return 0 if color is None else self.colors.index(tuple(_value(color))) + 1
+
+    # the key of a side, shape_type being a name or a ShapeType member
+    def edge_key(self, shape_type, color=None) -> int:
+        return edge_key(self.shape_types.index(_value(shape_type)), self.color_index(color))
+
+    def connectors(self, tile_id: int, rotation: int = 0) -> int:
+        return self._connectors[4 * tile_id + rotation % 4]
+
+    def side_key(self, tile_id: int, side: int, rotation: int = 0) -> int:
+        return self.connectors(tile_id, rotation) >> 8 * (3 - side) & 0xFF
+
+    # every (tile id, side) with key on that side when the tile isn't rotated
+    def tiles_with_edge(self, key: int) -> List[Tuple[int, int]]:
+        start, count = self._table[2 * key], self._table[2 * key + 1]
+        return [(entry >> 2, entry & 3) for entry in self._entries[start:start + count]]
+
+    # every (tile id, side) whose side has color_index when the tile isn't rotated, 0 being blank sides
+    def tiles_with_color(self, color_index: int) -> List[Tuple[int, int]]:
+        return [entry for type_id in range(EDGE_TYPE_COUNT)
+                for entry in self.tiles_with_edge(edge_key(type_id, color_index))]
+
+    # Every (tile id, rotation) that fits against side of tile_id (turned by rotation), i.e. that has
+    # the same color on the opposite side. For example side 1 gives the tiles that can go to its right.
+    def neighbors(self, tile_id: int, side: int, rotation: int = 0) -> List[Tuple[int, int]]:
+        key = self.side_key(tile_id, side, rotation)
+        if key == 0:
+            return []
+        facing = (side + 2) % 4
+        return [(other, (facing - other_side) % 4)
+                for other, other_side in self.tiles_with_color(key & EDGE_COLOR_MASK)]
@@ -4,15 +4,48 @@
 # B = line
 # C = nub
 # D = blank
+import contextlib
 import copy
+import hashlib
+import importlib
+import io
+import json
+import math
+import os
 import pathlib
 import shutil
-from dataclasses import dataclass
-from typing import Tuple, List
-from itertools import product
-from PIL import Image, ImageDraw, ImageFont
+import sys
+import threading
+import time
+import zlib
+from collections import Counter, defaultdict, deque
+from dataclasses import dataclass, fields, replace
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, Iterator, Tuple, List
+from itertools import chain, combinations, combinations_with_replacement, islice, product
 from enum import Enum
 
+
+class _LazyModule:
+    # Stands in for a module until one of its attributes is first used, so that importing this module
+    # (e.g. only to enumerate or count tiles) doesn't pay for importing Pillow
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if attr.startswith("__"):
+            # typing looks for special attributes on everything in an annotation like List[Image]
+            raise AttributeError(attr)
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+Image = _LazyModule("PIL.Image")
+ImageDraw = _LazyModule("PIL.ImageDraw")
+ImageFont = _LazyModule("PIL.ImageFont")
+
 top_index = 0
 right_index = 1
 bot_index = 2
@@ -20,6 +53,36 @@ left_index = 3
 
 PX_PER_TILE = 300
 LINE_WIDTH_PCT = 0.06
+# the "4+" label is 32pt on a 300px tile, and scales with it
+LABEL_TEXT = "4+"
+LABEL_FONT_PCT = 32 / 300
+# where the label's top left corner sits, as a fraction of the tile
+LABEL_POS = (0.03, 0.85)
+# upper bound on the fonts and on the decoded assets kept around by load_font/load_asset
+RESOURCE_CACHE_SIZE = 16
+FONT_PATH = "fonts/OpenSans-Regular.ttf"
+# upper bound on the shape masks kept around by shape_stamp; a deck only needs a handful of them
+STAMP_CACHE_SIZE = 64
+# the most tiles rasterize_tiles draws at once for draw_tiles and draw_archive, and the memory a batch may
+# take; see raster_batch_size
+RASTER_BATCH_SIZE = 8
+RASTER_BATCH_BYTES = 64 * 1024 * 1024
+# written by draw_tiles next to the tiles, recording what each file was rendered from
+MANIFEST_NAME = "manifest.json"
+# where the CLI keeps deck_enumeration results between runs
+ENUMERATION_CACHE_DIR = ".tile_cache"
+# bumped whenever enumeration or coloring changes in a way that makes earlier cached results wrong
+ENUMERATION_CACHE_VERSION = 1
+# shades between each pair of Color members in the palette output is quantized to, for the anti-aliased
+# edges of the label and of supersampled shapes
+PALETTE_BLEND_STEPS = 5
+ZLIB_STRATEGIES = {
+    "default": zlib.Z_DEFAULT_STRATEGY,
+    "filtered": zlib.Z_FILTERED,
+    "huffman": zlib.Z_HUFFMAN_ONLY,
+    "rle": zlib.Z_RLE,
+    "fixed": zlib.Z_FIXED,
+}
 
 top_pt = (0.5, 0)
 right_pt = (1, 0.5)
@@ -48,6 +111,12 @@ class Color(Enum):
     PINK = (255, 51, 255, 255)
 
 
+DEFAULT_COLORS = (Color.RED, Color.YELLOW, Color.GREEN, Color.BLUE)
+# the alphabet of shapes get_all_products lays out on a tile's sides
+DEFAULT_SHAPE_TYPES = (ShapeType.CORNER, ShapeType.LINE, ShapeType.BLANK, ShapeType.TEE)
+DEFAULT_NOVELTY_ASSETS = ("flip.png", "rotate.png")
+
+
 class SideNode:
     def __init__(self, shape_type: ShapeType, point: Tuple[float, float]):
         self.shape_type = shape_type
@@ -64,6 +133,12 @@ def index_rollover(original_position: int, size: int, increase: int) -> int:
 
 # Shape captures the necessary methods to draw a shape within a square canvas
 class Shape:
+    # shapes are made for every coloring of every layout, so they carry no __dict__
+    __slots__ = ('shape_type', 'color', 'canvas_px', 'points')
+
+    # whether set_color has any effect, i.e. whether the shape multiplies the number of colorings
+    colorable = True
+
     def __init__(self, shape_type: ShapeType, points, canvas_px: int):
         self.shape_type = shape_type
         self.color = Color.WHITE
@@ -73,23 +148,46 @@ class Shape:
     def __str__(self):
         return f'{self.shape_type.value} {self.points} {self.color}'
 
-    def draw(self, draw: ImageDraw):
+    # origin is where the tile's top left corner sits on the image being drawn on, fill overrides the
+    # shape's color, canvas_px the size the tile is drawn at and line_width_pct LINE_WIDTH_PCT
+    def draw(self, draw: ImageDraw, origin: Tuple[int, int] = (0, 0), fill=None, canvas_px: int = None,
+             line_width_pct: float = None):
         raise NotImplementedError
 
     def set_color(self, color: Color):
         self.color = color
 
+    @property
+    def signature(self) -> Tuple[str, Tuple[int, int, int, int]]:
+        # When deduping rotationally symmetrical shape/color pairs, ignoring position is necessary
+        return self.shape_type.value, self.color.value
+
+    # The shape's geometry as blocks of a pre-rasterized mask, each with its offset within the tile.
+    # Stamps are shared between every shape with the same geometry, whatever its color.
+    def stamp(self, canvas_px: int = None, line_width_pct: float = None) -> List[Tuple[Image, Tuple[int, int]]]:
+        points = tuple(self.points) if isinstance(self.points, list) else self.points
+        return shape_stamp(type(self), points, canvas_px or self.canvas_px, line_width_pct or LINE_WIDTH_PCT)
+
+    @property
+    def render_key(self) -> Tuple:
+        # unlike the signature this keeps the position, which changes what gets drawn
+        points = tuple(self.points) if self.points is not None else None
+        return self.shape_type.value, points, self.color.value
+
     def __eq__(self, other):
         if not isinstance(other, Shape):
             # don't attempt to compare against unrelated types
             return NotImplemented
 
-        # When deduping rotationally symmetrical shape/color pairs, ignoring position is necessary
-        return self.shape_type.value == other.shape_type.value and \
-               self.color.value == other.color.value
+        return self.signature == other.signature
+
+    def __hash__(self):
+        return hash(self.signature)
 
 @dataclass(eq=False)
 class Corner(Shape):
+    __slots__ = ('pta', 'ptb')
+
     def __init__(self, points: List[Tuple[float, float]], canvas_px: int):
         Shape.__init__(self, ShapeType.CORNER, points, canvas_px)
         if len(points) != 2:
@@ -98,46 +196,51 @@ class Corner(Shape):
             self.pta = points[0]
             self.ptb = points[1]
 
-    def draw(self, draw: ImageDraw):
+    def draw(self, draw: ImageDraw, origin: Tuple[int, int] = (0, 0), fill=None, canvas_px: int = None,
+             line_width_pct: float = None):
+        canvas_px = canvas_px or self.canvas_px
+        line_width_pct = line_width_pct or LINE_WIDTH_PCT
         # top right
         if self.pta == top_pt and self.ptb == right_pt or self.pta == right_pt and self.ptb == top_pt:
-            circle_xy0 = (0.5-LINE_WIDTH_PCT/2, -0.5-LINE_WIDTH_PCT/2)
-            circle_xy1 = (1.5+LINE_WIDTH_PCT/2, 0.5+LINE_WIDTH_PCT/2)
+            circle_xy0 = (0.5-line_width_pct/2, -0.5-line_width_pct/2)
+            circle_xy1 = (1.5+line_width_pct/2, 0.5+line_width_pct/2)
             start_deg = 90
             end_deg = 180
         # bot right
         elif self.pta == bot_pt and self.ptb == right_pt or self.pta == right_pt and self.ptb == bot_pt:
-            circle_xy0 = (0.5-LINE_WIDTH_PCT/2, 0.5-LINE_WIDTH_PCT/2)
-            circle_xy1 = (1.5+LINE_WIDTH_PCT/2, 1.5+LINE_WIDTH_PCT/2)
+            circle_xy0 = (0.5-line_width_pct/2, 0.5-line_width_pct/2)
+            circle_xy1 = (1.5+line_width_pct/2, 1.5+line_width_pct/2)
             start_deg = 180
             end_deg = 270
         # bot left
         elif self.pta == bot_pt and self.ptb == left_pt or self.pta == left_pt and self.ptb == bot_pt:
-            circle_xy0 = (-0.5-LINE_WIDTH_PCT/2, 0.5-LINE_WIDTH_PCT/2)
-            circle_xy1 = (0.5+LINE_WIDTH_PCT/2, 1.5+LINE_WIDTH_PCT/2)
+            circle_xy0 = (-0.5-line_width_pct/2, 0.5-line_width_pct/2)
+            circle_xy1 = (0.5+line_width_pct/2, 1.5+line_width_pct/2)
             start_deg = 270
             end_deg = 360
         # top left
         elif self.pta == top_pt and self.ptb == left_pt or self.pta == left_pt and self.ptb == top_pt:
-            circle_xy0 = (-0.5-LINE_WIDTH_PCT/2, -0.5-LINE_WIDTH_PCT/2)
-            circle_xy1 = (0.5+LINE_WIDTH_PCT/2, 0.5+LINE_WIDTH_PCT/2)
+            circle_xy0 = (-0.5-line_width_pct/2, -0.5-line_width_pct/2)
+            circle_xy1 = (0.5+line_width_pct/2, 0.5+line_width_pct/2)
             start_deg = 0
             end_deg = 90
         else:
             raise Exception
 
-        circle_xy0_px = tuple_multiply(circle_xy0, self.canvas_px)
-        circle_xy1_px = tuple_multiply(circle_xy1, self.canvas_px)
+        circle_xy0_px = tuple_offset(tuple_multiply(circle_xy0, canvas_px), origin)
+        circle_xy1_px = tuple_offset(tuple_multiply(circle_xy1, canvas_px), origin)
 
-        #print(f'{(circle_xy0_px, circle_xy1_px)}, {start_deg}, {end_deg},{int(self.canvas_px * LINE_WIDTH_PCT)}')
+        #print(f'{(circle_xy0_px, circle_xy1_px)}, {start_deg}, {end_deg},{int(canvas_px * line_width_pct)}')
 
-        draw.arc((circle_xy0_px, circle_xy1_px), start_deg, end_deg, fill=self.color.value,
-                 width=int(self.canvas_px * LINE_WIDTH_PCT))
+        draw.arc((circle_xy0_px, circle_xy1_px), start_deg, end_deg, fill=fill or self.color.value,
+                 width=int(canvas_px * line_width_pct))
 
         return
 
 @dataclass(eq=False)
 class Line(Shape):
+    __slots__ = ('pta', 'ptb')
+
     def __init__(self, points: List[Tuple[float, float]], canvas_px: int):
         Shape.__init__(self, ShapeType.LINE, points, canvas_px)
         if len(points) != 2:
@@ -146,7 +249,10 @@ class Line(Shape):
             self.pta = points[0]
             self.ptb = points[1]
 
-    def draw(self, draw: ImageDraw):
+    def draw(self, draw: ImageDraw, origin: Tuple[int, int] = (0, 0), fill=None, canvas_px: int = None,
+             line_width_pct: float = None):
+        canvas_px = canvas_px or self.canvas_px
+        line_width_pct = line_width_pct or LINE_WIDTH_PCT
         # top bot
         if self.pta == top_pt and self.ptb == bot_pt or self.pta == bot_pt and self.ptb == top_pt:
             xy0 = top_pt
@@ -158,21 +264,26 @@ class Line(Shape):
         else:
             raise Exception
 
-        xy0_px = tuple_multiply(xy0, self.canvas_px)
-        xy1_px = tuple_multiply(xy1, self.canvas_px)
+        xy0_px = tuple_offset(tuple_multiply(xy0, canvas_px), origin)
+        xy1_px = tuple_offset(tuple_multiply(xy1, canvas_px), origin)
 
-        draw.line((xy0_px, xy1_px), self.color.value, width=int(self.canvas_px * LINE_WIDTH_PCT))
+        draw.line((xy0_px, xy1_px), fill or self.color.value, width=int(canvas_px * line_width_pct))
 
         return
 
 @dataclass(eq=False)
 class Tee(Shape):
+    __slots__ = ()
+
     def __init__(self, points: List[Tuple[float, float, float]], canvas_px: int):
         Shape.__init__(self, ShapeType.TEE, points, canvas_px)
         if len(points) != 3:
             raise Exception
 
-    def draw(self, draw: ImageDraw):
+    def draw(self, draw: ImageDraw, origin: Tuple[int, int] = (0, 0), fill=None, canvas_px: int = None,
+             line_width_pct: float = None):
+        canvas_px = canvas_px or self.canvas_px
+        line_width_pct = line_width_pct or LINE_WIDTH_PCT
         xy1 = (0.5, 0.5) # middle
         for pt in self.points:
             # top
@@ -190,20 +301,25 @@ class Tee(Shape):
             else:
                 raise Exception(f'pt is {pt.__str__}, type {type(pt)}')
 
-            xy0_px = tuple_multiply(xy0, self.canvas_px)
-            xy1_px = tuple_multiply(xy1, self.canvas_px)
+            xy0_px = tuple_offset(tuple_multiply(xy0, canvas_px), origin)
+            xy1_px = tuple_offset(tuple_multiply(xy1, canvas_px), origin)
 
-            draw.line((xy0_px, xy1_px), self.color.value, width=int(self.canvas_px * LINE_WIDTH_PCT), joint="curve")
+            draw.line((xy0_px, xy1_px), fill or self.color.value, width=int(canvas_px * line_width_pct), joint="curve")
 
         return
 
 @dataclass(eq=False)
 class Nub(Shape):
+    __slots__ = ('pt',)
+
     def __init__(self, points: Tuple[float, float], canvas_px: int):
         Shape.__init__(self, ShapeType.NUB, points, canvas_px)
         self.pt = points
 
-    def draw(self, draw: ImageDraw):
+    def draw(self, draw: ImageDraw, origin: Tuple[int, int] = (0, 0), fill=None, canvas_px: int = None,
+             line_width_pct: float = None):
+        canvas_px = canvas_px or self.canvas_px
+        line_width_pct = line_width_pct or LINE_WIDTH_PCT
         nub_length = 0.25
         # top
         if self.pt == top_pt:
@@ -224,64 +340,242 @@ class Nub(Shape):
         else:
             raise Exception
 
-        xy0_px = tuple_multiply(xy0, self.canvas_px)
-        xy1_px = tuple_multiply(xy1, self.canvas_px)
+        xy0_px = tuple_offset(tuple_multiply(xy0, canvas_px), origin)
+        xy1_px = tuple_offset(tuple_multiply(xy1, canvas_px), origin)
 
-        draw.line((xy0_px, xy1_px), self.color.value, width=int(self.canvas_px * LINE_WIDTH_PCT), joint="curve")
+        draw.line((xy0_px, xy1_px), fill or self.color.value, width=int(canvas_px * line_width_pct), joint="curve")
 
         return
 
 @dataclass(eq=False)
 class Blank(Shape):
+    __slots__ = ()
+    colorable = False
+
     def __init__(self):
         Shape.__init__(self, ShapeType.BLANK, None, PX_PER_TILE)
 
-    def draw(self, background: Image) -> Image:
+    def draw(self, draw: ImageDraw, origin: Tuple[int, int] = (0, 0), fill=None, canvas_px: int = None,
+             line_width_pct: float = None):
         pass
 
+    def stamp(self, canvas_px: int = None, line_width_pct: float = None) -> List[Tuple[Image, Tuple[int, int]]]:
+        return []
+
     def set_color(self, color: Color):
         pass
 
 
+# PathTile holds its shapes packed into ints. From the low bits up a code is the color id, the shape
+# type and the geometry id, where colors and geometries (a shape's class, points and canvas size) are
+# interned the first time they're seen. The color and shape type bits together are what Shape.signature
+# compares, so a tile's signature is its codes masked and sorted. Ids are handed out per process, so
+# codes mustn't be compared across processes. Lookups take no lock, but handing out a new id does, since
+# preview_server builds tiles from several threads at once; an id is only published once its entry is in
+# the list, so a lookup never sees an id the list doesn't have yet.
+COLOR_BITS = 8
+SHAPE_TYPE_BITS = 3
+SIGNATURE_MASK = (1 << (COLOR_BITS + SHAPE_TYPE_BITS)) - 1
+SHAPE_TYPE_IDS = {t: i for i, t in enumerate(ShapeType)}
+
+_color_ids = {}
+_colors = []
+_geometry_ids = {}
+_geometries = []
+_decoded_shapes = {}
+_intern_lock = threading.Lock()
+
+
+def color_id(color) -> int:
+    i = _color_ids.get(color)
+    if i is None:
+        with _intern_lock:
+            i = _color_ids.get(color)
+            if i is None:
+                if len(_colors) == 1 << COLOR_BITS:
+                    raise ValueError(f"can't encode more than {1 << COLOR_BITS} colors")
+                i = len(_colors)
+                _colors.append(color)
+                _color_ids[color] = i
+    return i
+
+
+# the code of shape with its color bits left empty
+def geometry_code(shape: Shape) -> int:
+    points = tuple(shape.points) if isinstance(shape.points, list) else shape.points
+    key = (type(shape), points, shape.canvas_px)
+    i = _geometry_ids.get(key)
+    if i is None:
+        with _intern_lock:
+            i = _geometry_ids.get(key)
+            if i is None:
+                i = len(_geometries)
+                # kept as a template that decode_shape copies and colors
+                _geometries.append(copy.copy(shape))
+                _geometry_ids[key] = i
+    return (i << SHAPE_TYPE_BITS | SHAPE_TYPE_IDS[shape.shape_type]) << COLOR_BITS
+
+
+def encode_shape(shape: Shape) -> int:
+    return geometry_code(shape) | color_id(shape.color)
+
+
+# The returned shape is shared between every tile holding the same code, so it must not be modified
+def decode_shape(code: int) -> Shape:
+    shape = _decoded_shapes.get(code)
+    if shape is None:
+        shape = copy.copy(_geometries[code >> (COLOR_BITS + SHAPE_TYPE_BITS)])
+        shape.color = _colors[code & ((1 << COLOR_BITS) - 1)]
+        _decoded_shapes[code] = shape
+    return shape
+
+
+# line_width_pct is part of the key since a different width draws different masks
+@lru_cache(maxsize=STAMP_CACHE_SIZE)
+def shape_stamp(shape_cls: type, points: Tuple, canvas_px: int,
+                line_width_pct: float) -> List[Tuple[Image, Tuple[int, int]]]:
+    # A bilevel mask both matches Pillow's aliased drawing and lets paste copy pixels instead of
+    # blending them. Pasting costs about the same per pixel as drawing a stroke does, so the mask is
+    # cut into blocks and the empty ones are dropped; otherwise the inside of an arc's bounding box
+    # would cost more than the arc itself.
+    mask = Image.new('1', (canvas_px, canvas_px), 0)
+    shape_cls(points, canvas_px).draw(ImageDraw.Draw(mask), fill=1, line_width_pct=line_width_pct)
+    block_px = max(64, canvas_px // 16)
+    blocks = []
+    for y in range(0, canvas_px, block_px):
+        for x in range(0, canvas_px, block_px):
+            block = mask.crop((x, y, x + block_px, y + block_px))
+            bbox = block.getbbox()
+            if bbox is not None:
+                blocks.append((block.crop(bbox), (x + bbox[0], y + bbox[1])))
+    return blocks
+
+
+# at least 1pt, since a font can't be loaded at 0 and that's what the tiniest tiles round down to
+def label_font_size(canvas_px: int) -> int:
+    return max(1, round(LABEL_FONT_PCT * canvas_px))
+
+
+@lru_cache(maxsize=RESOURCE_CACHE_SIZE)
+def load_font(path: str, size: int) -> ImageFont:
+    return ImageFont.truetype(path, size)
+
+
+# The returned image is shared between every caller asking for the same (path, size), so it must not
+# be drawn on directly
+@lru_cache(maxsize=RESOURCE_CACHE_SIZE)
+def load_asset(path: str, size: Tuple[int, int]) -> Image:
+    with Image.open(path) as im:
+        return im.resize(size).convert('RGBA')
+
+
 class Tile:
-    def draw(self, background: Image) -> Image:
+    __slots__ = ()
+
+    # identifies what the tile looks like: tiles with equal keys draw identical images
+    @property
+    def render_key(self) -> Tuple:
+        raise NotImplementedError
+
+    # the files draw reads, whose modification invalidates a previously rendered image
+    @property
+    def resources(self) -> List[str]:
+        return [FONT_PATH]
+
+    # Draws the tile onto background, which must be RGBA, with the tile's top left corner at origin.
+    # The tile covers canvas_px (by default PX_PER_TILE) square pixels, so background can be a bigger
+    # sheet of tiles, and origin can be negative to draw only part of the tile. Paths are line_width_pct
+    # (by default LINE_WIDTH_PCT) of the tile wide.
+    def draw(self, background: Image, origin: Tuple[int, int] = (0, 0), canvas_px: int = None,
+             line_width_pct: float = None) -> Image:
+        canvas_px = canvas_px or PX_PER_TILE
         drawer = ImageDraw.Draw(background)
-        font = ImageFont.truetype("fonts/OpenSans-Regular.ttf", 32)
-        drawer.text(tuple_multiply((0.03, 0.85), PX_PER_TILE), "4+", Color.WHITE.value, font)
+        font = load_font(FONT_PATH, label_font_size(canvas_px))
+        drawer.text(tuple_offset(tuple_multiply(LABEL_POS, canvas_px), origin), LABEL_TEXT, Color.WHITE.value, font)
 
 
 class NoveltyTile(Tile):
+    __slots__ = ('image_path',)
+
     def __init__(self, image_path: str):
         self.image_path = image_path
 
-    def draw(self, background: Image) -> Image:
-        foreground = Image.open(self.image_path).resize(background.size)
-        composite_im = Image.alpha_composite(background.convert('RGBA'), foreground.convert('RGBA'))
-        super().draw(composite_im)
-        return composite_im
+    @property
+    def render_key(self) -> Tuple:
+        return "novelty", self.image_path
+
+    @property
+    def resources(self) -> List[str]:
+        return super().resources + [self.image_path]
+
+    def draw(self, background: Image, origin: Tuple[int, int] = (0, 0), canvas_px: int = None,
+             line_width_pct: float = None) -> Image:
+        canvas_px = canvas_px or PX_PER_TILE
+        foreground = load_asset(self.image_path, (canvas_px, canvas_px))
+        # alpha_composite only takes a destination inside background, so when the tile starts above or
+        # left of it the part of the asset that's cut off is skipped instead
+        dest = (max(origin[0], 0), max(origin[1], 0))
+        background.alpha_composite(foreground, dest, (dest[0] - origin[0], dest[1] - origin[1]))
+        super().draw(background, origin, canvas_px)
+        return background
 
 
 class PathTile(Tile):
+    # the tile's shapes, as encode_shape codes
+    __slots__ = ('codes',)
+
     def __init__(self, shapes: List[Shape]):
-        self.shapes = shapes
+        self.codes = tuple(encode_shape(s) for s in shapes)
+
+    @classmethod
+    def from_codes(cls, codes: Tuple[int, ...]) -> 'PathTile':
+        tile = cls.__new__(cls)
+        tile.codes = codes
+        return tile
+
+    # codes only mean something in the process that encoded them, so tiles are pickled (e.g. to be
+    # sent to a pool worker) as their shapes and encoded again on the other side
+    def __reduce__(self):
+        return PathTile, (self.shapes,)
+
+    @property
+    def shapes(self) -> List[Shape]:
+        return [decode_shape(c) for c in self.codes]
 
     def __str__(self):
         return f'Shapes: {[str(s) for s in self.shapes ]}'
         #return f'{self.shapes}'
 
-    def draw(self, background: Image) -> Image:
-        drawer = ImageDraw.Draw(background)
+    def draw(self, background: Image, origin: Tuple[int, int] = (0, 0), canvas_px: int = None,
+             line_width_pct: float = None) -> Image:
+        # Pillow draws without anti-aliasing, so filling a shape's stamp with its color sets exactly the
+        # pixels drawing the shape would, without rasterizing it again
         for shape in self.shapes:
-            shape.draw(drawer)
-        super().draw(background)
+            for mask, offset in shape.stamp(canvas_px, line_width_pct):
+                x, y = tuple_offset(offset, origin)
+                background.paste(shape.color.value, (x, y, x + mask.width, y + mask.height), mask)
+        super().draw(background, origin, canvas_px)
         return background
 
+    @property
+    def signature(self) -> Tuple:
+        # the sorted multiset of (shape type, color) pairs, so two tiles that only differ by where
+        # their shapes sit share a signature
+        return tuple(sorted(c & SIGNATURE_MASK for c in self.codes))
+
+    @property
+    def render_key(self) -> Tuple:
+        return ("path",) + tuple(s.render_key for s in self.shapes)
+
     def __eq__(self, other):
         if not isinstance(other, PathTile):
             # don't attempt to compare against unrelated types
             return NotImplemented
 
-        return sorted(self.shapes, key=lambda s: (s.shape_type.value, s.color.value)) == sorted(other.shapes, key=lambda s: (s.shape_type.value, s.color.value))
+        return self.signature == other.signature
+
+    def __hash__(self):
+        return hash(self.signature)
 
 
 class TilePattern:
@@ -343,26 +637,60 @@ class TilePattern:
             else:
                 raise Exception("unknown shape type")
 
-    def generate_colored(self, colors: List[Color]) -> List[PathTile]:
-        colored_tiles = []
-        colored_shapes = []
-        for s in self.shapes:
-            colored_shapes.append(list(product([s], colors, repeat=1)))
-
-        tiles_shapes_colors_tuples = list(product(*colored_shapes))
-
-        for tile_shapes_colors_tuples in tiles_shapes_colors_tuples:
-            colored_shapes = []
-            for shape_color_tuple in tile_shapes_colors_tuples:
-                shape = copy.copy(shape_color_tuple[0])
-                color = shape_color_tuple[1]
-                shape.set_color(color)
-                colored_shapes.append(shape)
-
-            new_tile = PathTile(colored_shapes)
-            if new_tile not in colored_tiles:
-                colored_tiles.append(new_tile)
-        return colored_tiles
+    # Shapes of the same type are interchangeable as far as PathTile equality goes, so each group of
+    # them only needs every multiset of colors rather than every ordering of them. Maps each shape type
+    # to the indexes of its shapes.
+    def _shape_groups(self) -> Dict[ShapeType, List[int]]:
+        groups = {}
+        for i, s in enumerate(self.shapes):
+            groups.setdefault(s.shape_type, []).append(i)
+        return groups
+
+    def generate_colored(self, colors: List[Color]) -> Iterator[PathTile]:
+        groups = self._shape_groups()
+        group_colorings = []
+        for indexes in groups.values():
+            if self.shapes[indexes[0]].colorable:
+                group_colorings.append(lambda k=len(indexes): combinations_with_replacement(colors, k))
+            else:
+                group_colorings.append(lambda k=len(indexes): [(None,) * k])
+
+        geometries = [geometry_code(s) for s in self.shapes]
+        uncolored = [encode_shape(s) for s in self.shapes]
+        color_ids = {c: color_id(c) for c in colors}
+        emitted = 0
+        for coloring in lazy_product(group_colorings):
+            codes = list(uncolored)
+            for indexes, group_colors in zip(groups.values(), coloring):
+                for i, color in zip(indexes, group_colors):
+                    if color is not None:
+                        codes[i] = geometries[i] | color_ids[color]
+            emitted += 1
+            yield PathTile.from_codes(tuple(codes))
+
+        # the colorings a full product over the shapes would have produced and thrown away as duplicates
+        instrumentation.count("generate_colored.tiles", emitted)
+        instrumentation.count("generate_colored.duplicates_skipped",
+                              len(colors) ** len(self.shapes) - emitted)
+
+    # how many tiles generate_colored yields for color_count colors, without making any of them
+    def coloring_count(self, color_count: int) -> int:
+        count = 1
+        for indexes in self._shape_groups().values():
+            if self.shapes[indexes[0]].colorable:
+                count *= math.comb(color_count + len(indexes) - 1, len(indexes))
+        return count
+
+
+def lazy_product(factories: List[Callable[[], Iterable]]) -> Iterator[Tuple]:
+    # like itertools.product, but each factor is re-created per outer item instead of being held as a
+    # tuple, so memory doesn't grow with the size of the factors
+    if not factories:
+        yield ()
+        return
+    for head in factories[0]():
+        for tail in lazy_product(factories[1:]):
+            yield (head,) + tail
 
 
 def tuple_multiply(t: Tuple, multiple: int) -> Tuple:
@@ -373,8 +701,12 @@ def tuple_add(t: Tuple, addition: any) -> Tuple:
     return tuple(x + addition for x in t)
 
 
-def get_all_products() -> list:
-    return list(product([ShapeType.CORNER, ShapeType.LINE, ShapeType.BLANK, ShapeType.TEE], repeat=4))
+def tuple_offset(t: Tuple, offset: Tuple) -> Tuple:
+    return tuple(x + o for x, o in zip(t, offset))
+
+
+def get_all_products(shape_types: Iterable[ShapeType] = DEFAULT_SHAPE_TYPES) -> list:
+    return list(product(shape_types, repeat=4))
 
 
 def filter_illegal(unfiltered: list) -> list:
@@ -461,86 +793,1201 @@ def filter_illegal(unfiltered: list) -> list:
 
     return apply_filter_blank(apply_filter_tee(apply_filter_line(apply_filter_corner(unfiltered))))
 
-def dedupe_rotational_symmetry(duped: list) -> list:
+# The side assignments each shape type may take, as 4 bit masks with the top side as the most
+# significant bit. These are the same minterms filter_illegal's filters are derived from.
+LEGAL_SIDE_MASKS = {
+    ShapeType.BLANK: (0, 1, 2, 3, 4, 5, 6, 8, 9, 10, 12),
+    ShapeType.CORNER: (0, 3, 6, 9, 12, 15),
+    ShapeType.LINE: (0, 5, 10, 15),
+    ShapeType.TEE: (0, 7, 11, 13, 14),
+}
+
+
+def encode_layouts(layouts: list):
+    # one row per layout, holding the index of each side's ShapeType in the enum. LEGAL_SIDE_MASKS are
+    # masks of four sides, so other layouts can't be checked against them and are rejected.
+    import numpy as np
+
+    if any(len(p) != 4 for p in layouts):
+        raise ValueError("only four-sided layouts can be encoded")
+    codes_by_type = {shape_type: code for code, shape_type in enumerate(ShapeType)}
+    return np.fromiter((codes_by_type[s] for p in layouts for s in p), dtype=np.uint8,
+                       count=len(layouts) * 4).reshape(-1, 4)
+
+
+def legal_layout_mask(layouts):
+    # Applies every rule in LEGAL_SIDE_MASKS to a whole array of encoded layouts at once: each shape
+    # type's sides are packed into a bit mask per row and looked up in a table of legal masks
+    import numpy as np
+
+    if layouts.ndim != 2 or layouts.shape[1] != 4:
+        raise ValueError(f'only four-sided layouts can be checked, not an array of shape {layouts.shape}')
+    side_count = layouts.shape[1]
+    weights = 1 << np.arange(side_count - 1, -1, -1)
+    shape_types = list(ShapeType)
+
+    legal = np.ones(len(layouts), dtype=bool)
+    for shape_type, masks in LEGAL_SIDE_MASKS.items():
+        lookup = np.zeros(1 << side_count, dtype=bool)
+        lookup[list(masks)] = True
+        legal &= lookup[(layouts == shape_types.index(shape_type)) @ weights]
+    return legal
+
+
+def filter_illegal_vectorized(unfiltered: list) -> list:
+    # same result as filter_illegal, in a single vectorized pass
+    import numpy as np
+
+    legal = legal_layout_mask(encode_layouts(unfiltered))
+    return [unfiltered[i] for i in np.flatnonzero(legal)]
+
+
+def canonical_layout(layout: tuple, reflect: bool = False) -> tuple:
+    # The lexicographically smallest rotation of the layout, also considering its mirror image when
+    # the tile can be flipped over. Layouts that are rotations (or reflections) of one another share it.
+    size = len(layout)
+    variants = [layout, tuple(reversed(layout))] if reflect else [layout]
+    rotations = (tuple(v[index_rollover(j, size, i)] for j in range(size)) for v in variants for i in range(size))
+    return min(rotations, key=lambda r: tuple(s.value for s in r))
+
+
+def dedupe_rotational_symmetry(duped: list, reflect: bool = False) -> list:
+    # keeps the first layout seen of each symmetry class, in input order
     deduped = []
+    seen = set()
     for d in duped:
-        is_dupe = False
-        for i in range(4):
-            shifted = (
-                d[index_rollover(0, 4, i)],
-                d[index_rollover(1, 4, i)],
-                d[index_rollover(2, 4, i)],
-                d[index_rollover(3, 4, i)]
-            )
-            if shifted in deduped:
-                is_dupe = True
-                break
-        if not is_dupe:
+        canonical = canonical_layout(d, reflect)
+        if canonical not in seen:
+            seen.add(canonical)
             deduped.append(d)
 
     return deduped
 
-def gen_starting_tiles(colors: List[Color]) -> List[PathTile]:
-    starters = []
+
+def construct_layouts(shape_types: Iterable[ShapeType] = DEFAULT_SHAPE_TYPES) -> list:
+    # The same layouts, in the same order, as dedupe_rotational_symmetry(filter_illegal(
+    # get_all_products(shape_types))), built a side at a time rather than filtered out of the product.
+    # A branch is dropped as soon as a shape type's sides so far can't be completed to one of its
+    # LEGAL_SIDE_MASKS (a corner without an adjacent corner, a line without its opposite, and so on),
+    # or as soon as a rotation of it is sure to come first in product order. What's left are the
+    # legal layouts that are the first of their rotations, which are the ones dedupe keeps.
+    shape_types = list(shape_types)
+    sides = 4
+    # the prefixes of each shape type's legal masks, by the number of sides assigned; types outside the
+    # alphabet never take a side, which every set of masks allows
+    prefixes = {t: [{m >> (sides - n) for m in masks} for n in range(sides + 1)]
+                for t, masks in LEGAL_SIDE_MASKS.items() if t in shape_types}
+    layouts = []
+    layout = []
+
+    # Generates necklaces the way the FKM algorithm does: period is the length of the prefix's
+    # shortest repeating unit, a side never sorts before the side a period earlier (or a later
+    # rotation would come first), and a full layout is the first of its rotations when its length is
+    # a multiple of the period.
+    def extend(period: int, masks: Tuple[int, ...]):
+        n = len(layout)
+        if n == sides:
+            if sides % period == 0:
+                layouts.append(tuple(shape_types[i] for i in layout))
+            return
+
+        for i in range(layout[n - period] if n else 0, len(shape_types)):
+            next_masks = tuple(mask << 1 | (t == shape_types[i]) for t, mask in zip(prefixes, masks))
+            if all(mask in prefixes[t][n + 1] for t, mask in zip(prefixes, next_masks)):
+                layout.append(i)
+                extend(period if n and i == layout[n - period] else n + 1, next_masks)
+                layout.pop()
+
+    extend(1, (0,) * len(prefixes))
+    return layouts
+
+
+# every distinct legal layout of the shape_types alphabet, kept for every deck drawn from it
+@lru_cache(maxsize=None)
+def enumerate_layouts(shape_types: Tuple[ShapeType, ...] = DEFAULT_SHAPE_TYPES) -> Tuple[tuple, ...]:
+    return tuple(construct_layouts(shape_types))
+
+
+def enumeration_key(shape_types: Iterable[ShapeType], colors: Iterable[Color]) -> str:
+    # a hash of everything deck_enumeration's result depends on
+    config = {
+        "version": ENUMERATION_CACHE_VERSION,
+        "shape_types": [t.value for t in shape_types],
+        "colors": [list(c.value) for c in colors],
+        "legal_side_masks": {t.value: list(masks) for t, masks in LEGAL_SIDE_MASKS.items()},
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def deck_enumeration(shape_types: Iterable[ShapeType], colors: List[Color],
+                     cache_dir: str = None) -> Tuple[Tuple[tuple, ...], Tuple[int, ...]]:
+    # The legal layouts of shape_types, and how many colorings each of them has with colors. With
+    # cache_dir set they're read from the file an earlier call stored them in, or stored there.
+    path = f'{cache_dir}/{enumeration_key(shape_types, colors)}.json' if cache_dir else None
+    if path is not None:
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+            layouts = tuple(tuple(ShapeType(value) for value in layout) for layout in cached["layouts"])
+            return layouts, tuple(cached["colorings"])
+        except (OSError, ValueError, KeyError):
+            # not cached yet, or unreadable; it's rewritten below
+            pass
+
+    layouts = enumerate_layouts(tuple(shape_types))
+    colorings = tuple(TilePattern(layout).coloring_count(len(colors)) for layout in layouts)
+    if path is not None:
+        pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        cached = {"layouts": [[s.value for s in layout] for layout in layouts], "colorings": colorings}
+        write_file(path, json.dumps(cached).encode())
+    return layouts, colorings
+
+
+def gen_starting_tiles(colors: List[Color]) -> Iterator[PathTile]:
     quad_nub = (ShapeType.NUB, ShapeType.NUB, ShapeType.NUB, ShapeType.NUB)
     pattern = TilePattern(quad_nub)
     for color in colors:
-        starting = pattern.generate_colored([color])
-        starters = starters + starting + starting
-    return starters
+        for starting in pattern.generate_colored([color]):
+            # every deck gets two of each starter
+            yield starting
+            yield starting
+
 
+def gen_path_tiles(layouts: Iterable[tuple], colors: List[Color]) -> Iterator[PathTile]:
+    yield from gen_starting_tiles(colors)
+    for shapes in layouts:
+        yield from TilePattern(shapes).generate_colored(colors)
 
-def gen_novelty_tiles(count: int, incl_star: bool) -> List[NoveltyTile]:
-    tiles = []
-    assets_dir = "assets"
-    novelty_shapes = ["flip.png", "rotate.png"]
+
+def gen_novelty_tiles(count: int, incl_star: bool) -> Iterator[NoveltyTile]:
+    novelty_shapes = list(DEFAULT_NOVELTY_ASSETS)
     if incl_star:
         novelty_shapes.append("star.png")
+    return gen_asset_tiles(novelty_shapes, count)
+
 
-    for shape in novelty_shapes:
+def gen_asset_tiles(assets: Iterable[str], count: int, assets_dir: str = "assets") -> Iterator[NoveltyTile]:
+    for asset in assets:
         for i in range(count):
-            tiles.append(NoveltyTile(assets_dir + "/" + shape))
-    return tiles
+            yield NoveltyTile(assets_dir + "/" + asset)
+
+
+class Instrumentation:
+    # Opt-in timers and counters for a deck build: stage timings, per-tile draw/encode/write timings,
+    # cache hits and colorings skipped. While disabled (the default) stage returns a shared no-op
+    # context and count/sample return straight away, so the hooks can stay in hot paths.
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.origin = time.perf_counter()
+        # (name, category, pid, start, duration), with start from perf_counter, for the trace
+        self.events = []
+        self.counters = Counter()
+        self.samples = defaultdict(list)
+
+    def stage(self, name: str):
+        if not self.enabled:
+            return _NO_STAGE
+        return self._stage(name)
+
+    @contextlib.contextmanager
+    def _stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.event(name, "stage", os.getpid(), start, time.perf_counter() - start)
+
+    def event(self, name: str, category: str, pid: int, start: float, duration: float):
+        if self.enabled:
+            self.events.append((name, category, pid, start, duration))
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def sample(self, name: str, seconds: float):
+        if self.enabled:
+            self.samples[name].append(seconds)
+
+    @staticmethod
+    def cache_counts() -> Dict[str, Tuple[int, int]]:
+        # hits and misses of this process's lru caches
+        return {name: tuple(cache.cache_info()[:2])
+                for name, cache in [("font", load_font), ("asset", load_asset), ("stamp", shape_stamp)]}
+
+    def cache_rates(self) -> dict:
+        # this process's lru caches, plus what pool workers sent back (see _draw_tile_jobs) as counters
+        rates = {}
+        for name, (hits, misses) in self.cache_counts().items():
+            rates[name] = (hits + self.counters[f'{name}_cache.hits'], misses + self.counters[f'{name}_cache.misses'])
+        rates["render"] = (self.counters["render_cache.hits"], self.counters["render_cache.misses"])
+        return rates
+
+    def summary(self) -> str:
+        lines = [f'{"stage":<32} {"total (s)":>10} {"calls":>6}']
+        stage_totals = defaultdict(lambda: [0.0, 0])
+        for name, category, pid, start, duration in self.events:
+            if category == "stage":
+                stage_totals[name][0] += duration
+                stage_totals[name][1] += 1
+        for name, (total, calls) in stage_totals.items():
+            lines.append(f'{name:<32} {total:>10.3f} {calls:>6}')
+
+        lines.append("")
+        lines.append(f'{"per tile (ms)":<32} {"count":>6} {"mean":>8} {"p50":>8} {"p90":>8} {"p99":>8} {"max":>8}')
+        for name, values in self.samples.items():
+            values = sorted(values)
+            def pct(p): return values[min(len(values) - 1, int(p * len(values)))] * 1e3
+            mean = sum(values) / len(values) * 1e3
+            lines.append(f'{name:<32} {len(values):>6} {mean:>8.3f} {pct(0.5):>8.3f} {pct(0.9):>8.3f} '
+                         f'{pct(0.99):>8.3f} {values[-1] * 1e3:>8.3f}')
+
+        lines.append("")
+        for name, (hits, misses) in self.cache_rates().items():
+            rate = hits / (hits + misses) if hits + misses else 0
+            lines.append(f'{name + " cache hit rate":<32} {rate:>9.1%} ({hits} hits, {misses} misses)')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'{name:<32} {value:>10}')
+        lines.append(f'{"peak RSS (MiB)":<32} {peak_rss() / 2 ** 20:>10.1f}')
+        return "\n".join(lines)
+
+    def chrome_trace(self) -> dict:
+        # Chrome's trace event format, viewable in chrome://tracing or Perfetto
+        events = [{
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "pid": pid,
+            "tid": pid,
+            "ts": (start - self.origin) * 1e6,
+            "dur": duration * 1e6,
+        } for name, category, pid, start, duration in self.events]
+        events.append({"name": "counters", "ph": "C", "pid": os.getpid(), "ts": 0,
+                       "args": dict(self.counters)})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_trace(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+_NO_STAGE = contextlib.nullcontext()
+
+instrumentation = Instrumentation()
+
+
+def peak_rss() -> int:
+    # in bytes, for this process and the largest of its finished children (e.g. pool workers)
+    import resource
+
+    scale = 1 if sys.platform == "darwin" else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+
+@dataclass(frozen=True)
+class RenderSettings:
+    # Tiles come out px_per_tile square. With supersample above 1 they're drawn that many times larger
+    # and box-filtered down, which smooths the edges Pillow draws without anti-aliasing. With strip_px
+    # set they're drawn that many output rows at a time, so the supersampled buffer only ever covers
+    # a strip of the tile rather than all of it.
+    # The rest are PNG encoder options: compress_level is zlib's 0-9 and compress_type its strategy
+    # (e.g. zlib.Z_RLE), with None leaving Pillow's defaults. With palette set tiles are written as
+    # P-mode images quantized to tile_palette(), which is exact for the Color members themselves.
+    # line_width_pct is how wide paths are drawn, as a fraction of the tile.
+    px_per_tile: int = PX_PER_TILE
+    supersample: int = 1
+    strip_px: int = None
+    compress_level: int = None
+    compress_type: int = None
+    palette: bool = False
+    line_width_pct: float = LINE_WIDTH_PCT
+
+    @property
+    def canvas_px(self) -> int:
+        return self.px_per_tile * self.supersample
+
+
+DEFAULT_RENDER_SETTINGS = RenderSettings()
+
+# the one scratch image render_tile draws supersampled strips into, reused from tile to tile
+_scratch = {}
+
+
+def scratch_buffer(size: Tuple[int, int]) -> Image:
+    buffer = _scratch.get(size)
+    if buffer is None:
+        _scratch.clear()
+        buffer = _scratch[size] = Image.new('RGBA', size)
+    return buffer
+
+
+def render_tile(tile: Tile, settings: RenderSettings = DEFAULT_RENDER_SETTINGS) -> Image:
+    px = settings.px_per_tile
+    if settings.supersample == 1 and settings.strip_px is None:
+        background = Image.new('RGBA', (px, px), Color.LIGHT_GREY.value)
+        return tile.draw(background, canvas_px=px, line_width_pct=settings.line_width_pct)
+
+    strip_px = min(settings.strip_px or px, px)
+    scratch = scratch_buffer((settings.canvas_px, strip_px * settings.supersample))
+    im = Image.new('RGBA', (px, px))
+    for y in range(0, px, strip_px):
+        scratch.paste(Color.LIGHT_GREY.value, (0, 0) + scratch.size)
+        tile.draw(scratch, (0, -y * settings.supersample), settings.canvas_px, settings.line_width_pct)
+        strip = scratch.reduce(settings.supersample) if settings.supersample > 1 else scratch
+        im.paste(strip.crop((0, 0, px, min(strip_px, px - y))), (0, y))
+    return im
+
+
+# A shape's geometry as the flat indexes of the pixels it covers on a canvas_px tile, taken from the
+# same masks shape_stamp draws so rasterize_tiles fills exactly the pixels Shape.draw would
+@lru_cache(maxsize=STAMP_CACHE_SIZE)
+def shape_coverage(shape_cls: type, points: Tuple, canvas_px: int, line_width_pct: float):
+    import numpy as np
+
+    covered = np.zeros((canvas_px, canvas_px), dtype=bool)
+    for block, (x, y) in shape_stamp(shape_cls, points, canvas_px, line_width_pct):
+        covered[y:y + block.height, x:x + block.width] |= np.asarray(block)
+    return np.flatnonzero(covered)
+
+
+# The label's box on a canvas_px tile, and how much of each pixel in it the text covers (0-255). Both are
+# None on tiles too small for the text to reach any pixel.
+@lru_cache(maxsize=RESOURCE_CACHE_SIZE)
+def label_coverage(canvas_px: int):
+    import numpy as np
+
+    mask = Image.new('L', (canvas_px, canvas_px))
+    font = load_font(FONT_PATH, label_font_size(canvas_px))
+    ImageDraw.Draw(mask).text(tuple_multiply(LABEL_POS, canvas_px), LABEL_TEXT, 255, font)
+    box = mask.getbbox()
+    if box is None:
+        return None, None
+    return box, np.asarray(mask.crop(box), dtype=np.int32)[..., None]
+
+
+# Renders tiles into one (len(tiles), px, px, 4) uint8 array, the same pixels render_tile draws. Path
+# tiles aren't drawn one at a time. Most of a tile is background, so only the output pixels some shape
+# or the label reaches are worked on: their canvas pixels start out as background, each shape writes
+# its color into those it covers as one uint32 per pixel, the label is blended over every tile together,
+# and each output pixel's supersample x supersample block is averaged. Other tiles go to render_tile.
+def rasterize_tiles(tiles: Iterable[Tile], settings: RenderSettings = DEFAULT_RENDER_SETTINGS):
+    import numpy as np
+
+    def rgba32(color: Tuple[int, int, int, int]):
+        return np.array(color, dtype=np.uint8).view(np.uint32)[0]
+
+    tiles = list(tiles)
+    n = settings.supersample
+    px = settings.px_per_tile
+    canvas_px = settings.canvas_px
+    background = rgba32(Color.LIGHT_GREY.value)
+    if not tiles:
+        return np.zeros((0, px, px, 4), dtype=np.uint8)
+
+    fills = []
+    coverages = {}
+    for i, tile in enumerate(tiles):
+        if not isinstance(tile, PathTile):
+            continue
+        for shape in tile.shapes:
+            if shape.shape_type == ShapeType.BLANK:
+                continue
+            points = tuple(shape.points) if isinstance(shape.points, list) else shape.points
+            key = (type(shape), points)
+            if key not in coverages:
+                coverages[key] = shape_coverage(type(shape), points, canvas_px, settings.line_width_pct)
+            fills.append((i, key, rgba32(shape.color.value)))
+    box, alpha = label_coverage(canvas_px)
+    if box is None:
+        label = np.zeros(0, dtype=np.intp)
+    else:
+        label_y, label_x = np.mgrid[box[1]:box[3], box[0]:box[2]]
+        label = (label_y * canvas_px + label_x).ravel()
+
+    if n == 1:
+        # every pixel is its own block, so tiles are drawn on directly
+        words = np.full((len(tiles), px * px), background, dtype=np.uint32)
+        positions = coverages
+        label_position = label
+    else:
+        # The output pixels anything is drawn on, and the canvas pixels of their blocks: every block's
+        # first pixel, then every block's second and so on, so averaging adds up long runs of pixels.
+        # positions and label_position are where canvas pixels ended up in that order.
+        touched = np.zeros(px * px, dtype=bool)
+        for canvas_index in chain(coverages.values(), [label]):
+            y, x = np.divmod(canvas_index, canvas_px)
+            touched[y // n * px + x // n] = True
+        out_index = np.flatnonzero(touched)
+        out_y, out_x = np.divmod(out_index, px)
+        block_y, block_x = np.divmod(np.arange(n * n), n)
+        block = ((out_y * n + block_y[:, None]) * canvas_px + out_x * n + block_x[:, None]).ravel()
+        position = np.zeros(canvas_px * canvas_px, dtype=np.intp)
+        position[block] = np.arange(len(block))
+        words = np.full((len(tiles), len(block)), background, dtype=np.uint32)
+        positions = {key: position[canvas_index] for key, canvas_index in coverages.items()}
+        label_position = position[label]
+
+    for i, key, color in fills:
+        words[i, positions[key]] = color
+
+    if len(label):
+        # blended the way Pillow blends antialiased text into an image
+        under = np.ascontiguousarray(words[:, label_position]).view(np.uint8).astype(np.int32)
+        under = under.reshape(len(tiles), len(label), 4)
+        blend = (np.array(Color.WHITE.value, dtype=np.int32) - under) * alpha.reshape(1, len(label), 1) + 128
+        blended = (under + (((blend >> 8) + blend) >> 8)).astype(np.uint8)
+        words[:, label_position] = blended.view(np.uint32)[..., 0]
+
+    if n > 1:
+        sums = words.view(np.uint8).reshape(len(tiles), n * n, len(out_index) * 4).sum(axis=1, dtype=np.uint32)
+        # Image.reduce's fixed point division, so the result matches render_tile to the bit
+        samples = ((sums + n * n // 2) * np.uint32(int((1 << 24) / (n * n))) >> 24).astype(np.uint8)
+        words = np.full((len(tiles), px * px), background, dtype=np.uint32)
+        words[:, out_index] = samples.view(np.uint32)
+    pixels = words.view(np.uint8).reshape(len(tiles), px, px, 4)
+
+    for i, tile in enumerate(tiles):
+        if not isinstance(tile, PathTile):
+            pixels[i] = np.asarray(render_tile(tile, settings))
+    return pixels
+
+
+class RenderCache:
+    # Remembers the first file each distinct image was written to, so later tiles with the same
+    # render key (in the same deck or another one) are linked to it instead of drawn and encoded again
+    def __init__(self):
+        self.paths = {}
+
+    def get(self, key: Tuple) -> str:
+        path = self.paths.get(key)
+        if path is not None and not os.path.exists(path):
+            # the deck it was written to has been cleared out since
+            del self.paths[key]
+            return None
+        return path
+
+    def add(self, key: Tuple, path: str):
+        self.paths[key] = path
+
+
+def render_params(settings: RenderSettings = DEFAULT_RENDER_SETTINGS) -> Tuple:
+    # strip_px is left out since drawing in strips doesn't change the result
+    return (settings.px_per_tile, settings.supersample, settings.line_width_pct, LABEL_FONT_PCT,
+            settings.compress_level, settings.compress_type, settings.palette)
+
+
+# The same palette is shared by every tile and deck: the Color members, then PALETTE_BLEND_STEPS
+# shades between each pair of them
+@lru_cache(maxsize=None)
+def tile_palette() -> Image:
+    colors = [c.value[:3] for c in Color]
+    for a, b in combinations(list(colors), 2):
+        for step in range(1, PALETTE_BLEND_STEPS + 1):
+            t = step / (PALETTE_BLEND_STEPS + 1)
+            colors.append(tuple(round(x + (y - x) * t) for x, y in zip(a, b)))
+    palette = Image.new('P', (1, 1))
+    palette.putpalette([v for color in colors for v in color])
+    return palette
+
+
+def encode_png(im: Image, settings: RenderSettings = DEFAULT_RENDER_SETTINGS) -> bytes:
+    options = {}
+    if settings.compress_level is not None:
+        options["compress_level"] = settings.compress_level
+    if settings.compress_type is not None:
+        options["compress_type"] = settings.compress_type
+    if settings.palette:
+        # tiles are opaque, so the alpha channel is dropped along the way
+        im = im.convert('RGB').quantize(palette=tile_palette(), dither=Image.Dither.NONE)
+    buffer = io.BytesIO()
+    im.save(buffer, "PNG", **options)
+    return buffer.getvalue()
+
+
+def link_or_copy(src: str, dst: str):
+    # dst is replaced rather than written through, since it may be a link shared with another deck
+    tmp = dst + ".tmp"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        # e.g. the decks live on different filesystems
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def write_file(path: str, data: bytes):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _input_digest(tile: Tile, key: Tuple, mtimes: dict) -> str:
+    # everything that goes into a tile's image: what it draws, how, and the files it reads
+    digest = hashlib.sha256(repr(key).encode())
+    for path in tile.resources:
+        if path not in mtimes:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        digest.update(f'{path}:{mtimes[path]}'.encode())
+    return digest.hexdigest()
+
+
+def load_manifest(out_dir: str) -> dict:
+    try:
+        with open(f'{out_dir}/{MANIFEST_NAME}') as f:
+            return json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+# About the most memory rasterize_tiles takes drawing count tiles. Supersampled, that's the position of
+# every canvas pixel and the index of every block pixel (8 bytes each, per canvas pixel at worst), then per
+# tile a uint32 for each canvas pixel plus the sums and samples of each output pixel. Otherwise it's the
+# tiles' own pixels and some temporaries.
+def raster_batch_bytes(settings: RenderSettings, count: int) -> int:
+    canvas = settings.canvas_px ** 2
+    if settings.supersample == 1:
+        return count * 6 * canvas
+    return 16 * canvas + count * (4 * canvas + 20 * settings.px_per_tile ** 2)
+
+
+# How many tiles are rasterized at once: up to RASTER_BATCH_SIZE, as many as fit in RASTER_BATCH_BYTES.
+# 0 when not even one does, and tiles are drawn one at a time by render_tile instead, which holds a
+# single canvas (or a strip of one with strip_px set).
+def raster_batch_size(settings: RenderSettings) -> int:
+    count = RASTER_BATCH_SIZE
+    while count and raster_batch_bytes(settings, count) > RASTER_BATCH_BYTES:
+        count -= 1
+    return count
+
+
+# A job is a tile, the settings it's drawn with, and its outputs: a (path, settings) pair for every size
+# it's written at, largest first, where the path is None for sizes that don't need writing this time.
+# Draws each job's tile, yielding it with its image and when drawing it started and finished. Tiles are
+# rasterized raster_batch_size at a time, each getting an equal share of the batch's time, unless
+# they're drawn in strips to save memory or are too big to batch. The jobs all share their settings, as
+# draw_tiles and draw_archive make them.
+def _render_jobs(jobs: List[Tuple[Tile, RenderSettings, Tuple]]) -> Iterator[Tuple[Tuple, Image, float, float]]:
+    batch_size = raster_batch_size(jobs[0][1]) if jobs and jobs[0][1].strip_px is None else 0
+    if not batch_size:
+        for job in jobs:
+            start = time.perf_counter()
+            yield job, render_tile(job[0], job[1]), start, time.perf_counter()
+        return
 
+    for c in range(0, len(jobs), batch_size):
+        batch = jobs[c:c + batch_size]
+        start = time.perf_counter()
+        pixels = rasterize_tiles([tile for tile, _, _ in batch], batch[0][1])
+        each = (time.perf_counter() - start) / len(batch)
+        for n, job in enumerate(batch):
+            yield job, Image.fromarray(pixels[n], 'RGBA'), start + n * each, start + (n + 1) * each
+
+
+# Each size is box filtered down from the one before it, rather than drawn again, so the label and lines
+# keep their proportions and every size after the first costs a fraction of drawing it. Yields the image
+# for each output with when making it started and finished.
+def _mip_chain(im: Image, outputs: Tuple, start: float,
+               drawn: float) -> Iterator[Tuple[str, Image, RenderSettings, float, float]]:
+    for path, settings in outputs:
+        if im.width != settings.px_per_tile:
+            start = time.perf_counter()
+            im = im.resize((settings.px_per_tile, settings.px_per_tile), Image.Resampling.BOX)
+            drawn = time.perf_counter()
+        if path is not None:
+            yield path, im, settings, start, drawn
+
+
+def _write_tile(path: str, im: Image, settings: RenderSettings, start: float,
+                drawn: float) -> Tuple[str, str, Tuple]:
+    # returns the file written, its digest, and when each step started and finished for instrumentation
+    encoding = time.perf_counter()
+    data = encode_png(im, settings)
+    encoded = time.perf_counter()
+    write_file(path, data)
+    return path, hashlib.sha256(data).hexdigest(), \
+        (os.getpid(), start, drawn, encoding, encoded, time.perf_counter())
+
+
+# Along with what _write_tile returns for each file, returns how many hits and misses the process's lru
+# caches had while drawing, for the parent to count when this runs on a pool worker
+def _draw_tile_jobs(jobs: List[Tuple[Tile, RenderSettings, Tuple]],
+                    writers: int = 0) -> Tuple[List[Tuple[str, str, Tuple]], Dict[str, Tuple[int, int]]]:
+    before = Instrumentation.cache_counts()
+    results = _write_tile_jobs(jobs, writers)
+    after = Instrumentation.cache_counts()
+    return results, {name: (hits - before[name][0], misses - before[name][1])
+                     for name, (hits, misses) in after.items()}
+
+
+def _write_tile_jobs(jobs: List[Tuple[Tile, RenderSettings, Tuple]], writers: int) -> List[Tuple[str, str, Tuple]]:
+    if not writers:
+        return [_write_tile(*output) for (_, _, outputs), im, start, drawn in _render_jobs(jobs)
+                for output in _mip_chain(im, outputs, start, drawn)]
+
+    # Pillow encodes and the OS writes without holding the GIL, so the next tiles are drawn while the
+    # previous ones are written. Every image is drawn into new memory, so nothing drawn later changes
+    # an image that's still waiting to be written.
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=writers) as executor:
+        futures = [executor.submit(_write_tile, *output) for (_, _, outputs), im, start, drawn in _render_jobs(jobs)
+                   for output in _mip_chain(im, outputs, start, drawn)]
+        return [future.result() for future in futures]
+
+
+class _Batch:
+    def __init__(self, results: list, rendered: dict, links: list):
+        # results holds futures when drawing on a pool, or what _draw_tile_jobs returned otherwise
+        self.results = results
+        self.rendered = rendered
+        self.links = links
+
+
+# Batches default to 32 tiles per worker, so a deck with no workers or empty batches would quietly come
+# out empty
+def _check_batching(workers: int, batch_size: int = None):
+    if workers < 1:
+        raise ValueError(f'workers must be at least 1, not {workers}')
+    if batch_size is not None and batch_size < 1:
+        raise ValueError(f'batch_size must be at least 1, not {batch_size}')
+
+
+def draw_tiles(tiles: Iterable[Tile], out_dir: str, workers: int = 1, render_cache: RenderCache = None,
+               batch_size: int = None, incremental: bool = False,
+               settings: RenderSettings = DEFAULT_RENDER_SETTINGS, writers: int = 0, sizes: Iterable[int] = ()):
+    # writers is the number of threads each drawing process encodes and writes tiles on, none meaning
+    # it does so itself between tiles.
+    # Each of sizes, which must be smaller than settings.px_per_tile, gets a copy of every tile in
+    # out_dir/{px}px, made by scaling down the tile drawn at full size rather than drawing it again.
+    # With incremental set, out_dir is kept and only tiles whose inputs differ from the last run's
+    # manifest are redrawn; files the manifest lists but the deck no longer has are deleted.
+    # Otherwise out_dir is cleared first.
+    _check_batching(workers, batch_size)
+    sizes = sorted(set(sizes), reverse=True)
+    if sizes and sizes[0] >= settings.px_per_tile:
+        raise ValueError(f'sizes must be smaller than the {settings.px_per_tile}px tiles are drawn at')
+    # where each size goes, its settings, and what its images are made with. A size is scaled down
+    # from every larger one in turn, so the sizes above it are part of its render key.
+    levels = [("", settings, render_params(settings))]
+    for px in sizes:
+        levels.append((f'{px}px/', replace(settings, px_per_tile=px), levels[-1][2] + (px,)))
+
+    if not incremental:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    for prefix, _, _ in levels:
+        pathlib.Path(f'{out_dir}/{prefix}').mkdir(parents=True, exist_ok=True)
+    old_manifest = load_manifest(out_dir) if incremental else {}
+    manifest = {}
+    mtimes = {}
+    digests = {}
+    if render_cache is None:
+        render_cache = RenderCache()
+    if batch_size is None:
+        batch_size = 32 * workers
+
+    # Tiles are pulled from the iterable a batch at a time, and at most one batch is drawing while the
+    # next one is generated, so memory doesn't depend on the size of the deck.
+    # The file name is fixed by the tile's position in the stream, so the output doesn't depend on
+    # which worker happens to render a given tile.
+    # imported here, like Pillow is lazily, since multiprocessing is slow to import
+    from concurrent.futures import ProcessPoolExecutor
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    in_flight = {}
+    pending = deque()
+    count = 0
+    try:
+        tiles = iter(tiles)
+        while True:
+            with instrumentation.stage("generate"):
+                batch = list(islice(tiles, batch_size))
+            if not batch:
+                break
 
-def draw_tiles(tiles: List[Tile], out_dir: str):
-    shutil.rmtree(out_dir)
+            jobs = []
+            rendered = {}
+            links = []
+            for i, tile in enumerate(batch, count):
+                outputs = []
+                for prefix, level_settings, params in levels:
+                    name = f'{prefix}{i}.png'
+                    path = f'{out_dir}/{name}'
+                    key = (tile.render_key, params)
+                    input_digest = _input_digest(tile, key, mtimes)
+                    previous = old_manifest.get(name)
+                    outputs.append((None, level_settings))
+                    if previous is not None and previous["input"] == input_digest and os.path.exists(path):
+                        instrumentation.count("manifest.unchanged")
+                        manifest[name] = previous
+                        digests[path] = previous["output"]
+                        if key not in in_flight:
+                            render_cache.add(key, path)
+                        continue
+
+                    manifest[name] = {"input": input_digest}
+                    src = in_flight.get(key) or render_cache.get(key)
+                    if src is None:
+                        instrumentation.count("render_cache.misses")
+                        in_flight[key] = path
+                        rendered[key] = path
+                        outputs[-1] = (path, level_settings)
+                    else:
+                        instrumentation.count("render_cache.hits")
+                        links.append((src, path))
+                # sizes below the smallest one being written don't need making
+                while outputs and outputs[-1][0] is None:
+                    outputs.pop()
+                if outputs:
+                    jobs.append((tile, settings, tuple(outputs)))
+            count += len(batch)
+
+            if executor is None:
+                results = [_draw_tile_jobs(jobs, writers)]
+            else:
+                chunksize = max(1, -(-len(jobs) // workers))
+                results = [executor.submit(_draw_tile_jobs, jobs[c:c + chunksize], writers)
+                           for c in range(0, len(jobs), chunksize)]
+            pending.append(_Batch(results, rendered, links))
+
+            while len(pending) > 1:
+                _finish_batch(pending.popleft(), in_flight, render_cache, digests)
+        while pending:
+            _finish_batch(pending.popleft(), in_flight, render_cache, digests)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    for name, entry in manifest.items():
+        entry["output"] = digests[f'{out_dir}/{name}']
+    for name in old_manifest.keys() - manifest.keys():
+        pathlib.Path(f'{out_dir}/{name}').unlink(missing_ok=True)
+    write_file(f'{out_dir}/{MANIFEST_NAME}', json.dumps({"files": manifest}, indent=1).encode())
+    print(count)
+    return count
+
+
+def _finish_batch(batch: _Batch, in_flight: dict, render_cache: RenderCache, digests: dict):
+    for result in batch.results:
+        if isinstance(result, tuple):
+            # drawn in this process, whose caches cache_rates reads directly
+            files, _ = result
+        else:
+            # result() surfaces exceptions raised in a worker
+            files, caches = result.result()
+            for name, (hits, misses) in caches.items():
+                instrumentation.count(f'{name}_cache.hits', hits)
+                instrumentation.count(f'{name}_cache.misses', misses)
+        for path, digest, (pid, start, drawn, encoding, encoded, written) in files:
+            digests[path] = digest
+            instrumentation.sample("draw", drawn - start)
+            instrumentation.sample("encode", encoded - encoding)
+            instrumentation.sample("write", written - encoded)
+            instrumentation.event("draw", "tile", pid, start, drawn - start)
+            instrumentation.event("encode", "tile", pid, encoding, encoded - encoding)
+            instrumentation.event("write", "tile", pid, encoded, written - encoded)
+    for key, path in batch.rendered.items():
+        del in_flight[key]
+        render_cache.add(key, path)
+    # a link's source is either in this batch or an earlier one, so it has been written by now
+    for src, dst in batch.links:
+        start = time.perf_counter()
+        link_or_copy(src, dst)
+        instrumentation.sample("link", time.perf_counter() - start)
+        if src not in digests:
+            # rendered into another deck
+            digests[src] = file_digest(src)
+        digests[dst] = digests[src]
+
+
+def _sheet_layout(columns: int, rows: int, bleed: int, margin: int, px: int) -> Tuple[int, int]:
+    cell_px = px + 2 * bleed
+    return cell_px, (2 * margin + columns * cell_px, 2 * margin + rows * cell_px)
+
+
+def _extend_bleed(sheet: Image, x: int, y: int, bleed: int, px: int):
+    # smear the tile's outermost pixels into the bleed around it, so a slightly-off cut doesn't show
+    # the sheet's background or chop off a path where it meets the edge
+    sheet.paste(sheet.crop((x, y, x + px, y + 1)).resize((px, bleed)), (x, y - bleed))
+    sheet.paste(sheet.crop((x, y + px - 1, x + px, y + px)).resize((px, bleed)), (x, y + px))
+    sheet.paste(sheet.crop((x, y - bleed, x + 1, y + px + bleed)).resize((bleed, px + 2 * bleed)),
+                (x - bleed, y - bleed))
+    sheet.paste(sheet.crop((x + px - 1, y - bleed, x + px, y + px + bleed)).resize((bleed, px + 2 * bleed)),
+                (x + px, y - bleed))
+
+
+# Draws tiles onto a single columns x rows sheet, returning it along with the top left corner of
+# each tile on it
+def render_sheet(tiles: List[Tile], columns: int, rows: int, bleed: int = 0, margin: int = 0,
+                 settings: RenderSettings = DEFAULT_RENDER_SETTINGS) -> Tuple[Image, List[Tuple[int, int]]]:
+    px = settings.px_per_tile
+    cell_px, sheet_size = _sheet_layout(columns, rows, bleed, margin, px)
+    sheet = Image.new('RGBA', sheet_size, Color.WHITE.value)
+
+    positions = []
+    for n, tile in enumerate(tiles):
+        x = margin + (n % columns) * cell_px + bleed
+        y = margin + (n // columns) * cell_px + bleed
+        if settings.supersample == 1:
+            sheet.paste(Color.LIGHT_GREY.value, (x, y, x + px, y + px))
+            # drawn straight into its cell rather than onto a tile-sized image that then gets pasted
+            tile.draw(sheet, (x, y), px, settings.line_width_pct)
+        else:
+            sheet.paste(render_tile(tile, settings), (x, y))
+        if bleed:
+            _extend_bleed(sheet, x, y, bleed, px)
+        positions.append((x, y))
+    return sheet, positions
+
+
+def _draw_sheet(job: Tuple[int, int, List[Tile], str, int, int, int, int, RenderSettings]) -> dict:
+    sheet_index, first_id, tiles, out_dir, columns, rows, bleed, margin, settings = job
+    px = settings.px_per_tile
+    name = f'sheet_{sheet_index}.png'
+    sheet, positions = render_sheet(tiles, columns, rows, bleed, margin, settings)
+    write_file(f'{out_dir}/{name}', encode_png(sheet, settings))
+    return {str(first_id + n): {"sheet": name, "x": x, "y": y, "w": px, "h": px}
+            for n, (x, y) in enumerate(positions)}
+
+
+def draw_sheets(tiles: Iterable[Tile], out_dir: str, columns: int = 10, rows: int = 10, bleed: int = 0,
+                margin: int = 0, workers: int = 1, settings: RenderSettings = DEFAULT_RENDER_SETTINGS):
+    # Packs tiles onto sheet_{n}.png atlases, columns x rows tiles per sheet, and writes index.json
+    # mapping each tile id (its position in tiles) to the trimmed rectangle it occupies. Every tile gets
+    # bleed pixels of its own edge around it, and each sheet has a margin of blank paper.
+    shutil.rmtree(out_dir, ignore_errors=True)
+    pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+    per_sheet = columns * rows
+    cell_px, sheet_size = _sheet_layout(columns, rows, bleed, margin, settings.px_per_tile)
+    index = {
+        "tile_px": settings.px_per_tile,
+        "sheet_size": list(sheet_size),
+        "columns": columns,
+        "rows": rows,
+        "bleed": bleed,
+        "margin": margin,
+        "sheets": [],
+        "tiles": {},
+    }
+
+    def jobs():
+        tile_iter = iter(tiles)
+        sheet_index = 0
+        while True:
+            sheet_tiles = list(islice(tile_iter, per_sheet))
+            if not sheet_tiles:
+                return
+            yield (sheet_index, sheet_index * per_sheet, sheet_tiles, out_dir, columns, rows, bleed, margin,
+                   settings)
+            sheet_index += 1
+
+    def add_to_index(sheet_index: dict):
+        index["sheets"].append(next(iter(sheet_index.values()))["sheet"])
+        index["tiles"].update(sheet_index)
+
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        # keep a couple of sheets queued per worker, rather than generating the whole deck up front
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for job in jobs():
+                pending.append(executor.submit(_draw_sheet, job))
+                while len(pending) > 2 * workers:
+                    add_to_index(pending.popleft().result())
+            while pending:
+                add_to_index(pending.popleft().result())
+    else:
+        for job in jobs():
+            add_to_index(_draw_sheet(job))
+
+    with open(f'{out_dir}/index.json', "w") as f:
+        json.dump(index, f, indent=2)
+    print(len(index["tiles"]))
+    return len(index["tiles"])
+
+
+# A 64 bit digest of what tile is made of: PathTile.signature for path tiles, or the asset it shows.
+# Unlike the signature's codes it means the same thing in every process, so it can be written to a file.
+def signature_digest(tile: Tile) -> int:
+    if isinstance(tile, PathTile):
+        parts = sorted(s.signature for s in tile.shapes)
+    else:
+        parts = tile.render_key
+    return int.from_bytes(hashlib.blake2b(repr(parts).encode(), digest_size=8).digest(), "little")
+
+
+def _render_archive_tiles(job: Tuple[List[Tile], RenderSettings, int, int]) -> List[bytes]:
+    tiles, settings, compression, level = job
+    from tile_archive import pack_pixels
+
+    # drawn the way draw_tiles draws them, in strips with strip_px set
+    return [pack_pixels(im.tobytes(), compression, level)
+            for _, im, _, _ in _render_jobs([(tile, settings, ()) for tile in tiles])]
+
+
+def draw_archive(tiles: Iterable[Tile], out_dir: str, workers: int = 1,
+                 settings: RenderSettings = DEFAULT_RENDER_SETTINGS, compression: str = "raw",
+                 level: int = 1, batch_size: int = None):
+    # Writes tiles into a single tile_archive file, out_dir/ARCHIVE_NAME, as RGBA pixels either raw or
+    # zlib compressed at level. Tiles that look the same are only drawn and stored once.
+    from tile_archive import ARCHIVE_NAME, COMPRESSIONS, ArchiveWriter
+
+    compression = COMPRESSIONS[compression]
+    _check_batching(workers, batch_size)
+    shutil.rmtree(out_dir, ignore_errors=True)
     pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
-    i = 0
+    if batch_size is None:
+        batch_size = 32 * workers
+    px = settings.px_per_tile
+    from concurrent.futures import ProcessPoolExecutor
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    drawn = set()
+    pending = deque()
+
+    def finish(writer: ArchiveWriter, batch: List[Tuple[Tile, Tuple, bool]], results: list):
+        data = iter(chain.from_iterable(r if isinstance(r, list) else r.result() for r in results))
+        for tile, key, rendered in batch:
+            writer.add(signature_digest(tile), (px, px), next(data) if rendered else None, compression, key)
+
+    try:
+        with ArchiveWriter(f'{out_dir}/{ARCHIVE_NAME}') as writer:
+            tiles = iter(tiles)
+            while True:
+                with instrumentation.stage("generate"):
+                    batch = []
+                    for tile in islice(tiles, batch_size):
+                        key = tile.render_key
+                        batch.append((tile, key, key not in drawn))
+                        drawn.add(key)
+                if not batch:
+                    break
+                jobs = [tile for tile, _, rendered in batch if rendered]
+                if executor is None:
+                    results = [_render_archive_tiles((jobs, settings, compression, level))]
+                else:
+                    chunksize = max(1, -(-len(jobs) // workers))
+                    results = [executor.submit(_render_archive_tiles,
+                                               (jobs[c:c + chunksize], settings, compression, level))
+                               for c in range(0, len(jobs), chunksize)]
+                # like draw_tiles, the next batch is generated while this one draws
+                pending.append((batch, results))
+                while len(pending) > 1:
+                    finish(writer, *pending.popleft())
+            while pending:
+                finish(writer, *pending.popleft())
+            count = len(writer.entries)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    print(count)
+    return count
+
+
+# the points shapes end at, indexed by side
+SIDE_POINTS = (top_pt, right_pt, bot_pt, left_pt)
+
+
+# What reaches each side of a path tile, top first and going clockwise: the type and color of the
+# shape that ends there, or an uncolored blank. None for tiles without paths.
+def tile_sides(tile: Tile) -> List[Tuple[ShapeType, Color]]:
+    if not isinstance(tile, PathTile):
+        return None
+    sides = [(ShapeType.BLANK, None)] * len(SIDE_POINTS)
+    for shape in tile.shapes:
+        if shape.shape_type == ShapeType.NUB:
+            points = [shape.points]
+        else:
+            points = shape.points or []
+        for point in points:
+            sides[SIDE_POINTS.index(point)] = (shape.shape_type, shape.color)
+    return sides
+
+
+# passes tiles through, adding each one's sides to an edge_index.EdgeIndexBuilder on the way
+def track_edges(tiles: Iterable[Tile], edges) -> Iterator[Tile]:
     for tile in tiles:
-        background = Image.new('RGBA', (PX_PER_TILE, PX_PER_TILE), Color.LIGHT_GREY.value)
-        im = tile.draw(background)
-        # im.show()
-        im.save(f'{out_dir}/{i}.png', "PNG")
-        i += 1
-    print(len(tiles))
+        sides = tile_sides(tile)
+        if sides is not None:
+            sides = [(shape_type.value, None if color is None else color.value) for shape_type, color in sides]
+        edges.add(sides)
+        yield tile
+
+
+@dataclass(frozen=True)
+class DeckSpec:
+    # A deck is the starters and every legal layout of shape_types in every coloring from colors,
+    # followed by novelty_count (by default one per color) of each asset in novelty_assets. It's drawn
+    # with settings into out_dir, as one PNG per tile with format "tiles", onto columns x rows sheets
+    # with format "sheets", or into a single tile_archive file with format "archive", its pixels
+    # compressed with archive_compression ("raw" or "zlib"). Format "tiles" also writes a copy of the
+    # deck at each of sizes, see draw_tiles. With edge_index set an edge_index file goes alongside.
+    out_dir: str
+    colors: Tuple[Color, ...] = DEFAULT_COLORS
+    shape_types: Tuple[ShapeType, ...] = DEFAULT_SHAPE_TYPES
+    novelty_assets: Tuple[str, ...] = DEFAULT_NOVELTY_ASSETS
+    novelty_count: int = None
+    settings: RenderSettings = DEFAULT_RENDER_SETTINGS
+    format: str = "tiles"
+    edge_index: bool = True
+    columns: int = 10
+    rows: int = 10
+    bleed: int = 0
+    margin: int = 0
+    archive_compression: str = "raw"
+    sizes: Tuple[int, ...] = ()
+
+    def __post_init__(self):
+        if self.format not in ("tiles", "sheets", "archive"):
+            raise ValueError(f'unknown deck format "{self.format}"')
+        if self.sizes and self.format != "tiles":
+            raise ValueError(f'sizes only apply to format "tiles", not "{self.format}"')
+
+    @property
+    def copies_per_asset(self) -> int:
+        return len(self.colors) if self.novelty_count is None else self.novelty_count
+
+
+DEFAULT_DECKS = [
+    DeckSpec("tilesA"),
+    # tees need three sides of the tile, so they're left out of the smaller deck
+    DeckSpec("tilesB", shape_types=(ShapeType.CORNER, ShapeType.LINE, ShapeType.BLANK),
+             novelty_assets=DEFAULT_NOVELTY_ASSETS + ("star.png",)),
+]
+
+
+def generate_decks(specs: Iterable[DeckSpec], workers: int = None, writers: int = 0,
+                   render_cache: RenderCache = None, cache_dir: str = None,
+                   incremental: bool = False) -> Dict[str, int]:
+    # Draws each deck in turn and returns how many tiles went into each out_dir. Layouts are
+    # enumerated once per shape alphabet (and kept in cache_dir, if set, for later runs), and an image
+    # any earlier deck has rendered is linked rather than drawn again. Decks are generated lazily as
+    # they're drawn; going over the layouts again is cheap next to rendering. With incremental set,
+    # decks of format "tiles" only redraw what changed since the last build, see draw_tiles.
+    workers = workers or os.cpu_count() or 1
+    if render_cache is None:
+        render_cache = RenderCache()
+    counts = {}
+    for spec in specs:
+        with instrumentation.stage("enumerate layouts"):
+            layouts, _ = deck_enumeration(spec.shape_types, spec.colors, cache_dir)
+        tiles = chain(gen_path_tiles(layouts, spec.colors),
+                      gen_asset_tiles(spec.novelty_assets, spec.copies_per_asset))
+        edges = None
+        if spec.edge_index:
+            from edge_index import EdgeIndexBuilder
+
+            edges = EdgeIndexBuilder()
+            tiles = track_edges(tiles, edges)
+        with instrumentation.stage(f'deck {spec.out_dir}'):
+            if spec.format == "sheets":
+                counts[spec.out_dir] = draw_sheets(tiles, spec.out_dir, spec.columns, spec.rows, spec.bleed,
+                                                   spec.margin, workers, spec.settings)
+            elif spec.format == "archive":
+                counts[spec.out_dir] = draw_archive(tiles, spec.out_dir, workers, spec.settings,
+                                                    spec.archive_compression)
+            else:
+                counts[spec.out_dir] = draw_tiles(tiles, spec.out_dir, workers, render_cache,
+                                                  incremental=incremental, settings=spec.settings,
+                                                  writers=writers, sizes=spec.sizes)
+            if edges is not None:
+                from edge_index import EDGE_INDEX_NAME
+
+                edges.write(f'{spec.out_dir}/{EDGE_INDEX_NAME}')
+    return counts
+
+
+def count_tiles(spec: DeckSpec, cache_dir: str = None) -> int:
+    # how many tiles generate_decks draws for spec, without generating (or importing Pillow for) any
+    _, colorings = deck_enumeration(spec.shape_types, spec.colors, cache_dir)
+    # each starter appears twice
+    return 2 * len(spec.colors) + sum(colorings) + len(spec.novelty_assets) * spec.copies_per_asset
+
+
+def deck_spec_from_dict(deck: dict, settings: RenderSettings = DEFAULT_RENDER_SETTINGS) -> DeckSpec:
+    # Colors and shape types are given by name, e.g. {"out_dir": "tiles", "colors": ["RED", "BLUE"]},
+    # compress_type by its name in ZLIB_STRATEGIES, and any RenderSettings field overrides settings
+    deck = dict(deck)
+    setting_names = {f.name for f in fields(RenderSettings)}
+    overrides = {name: deck.pop(name) for name in setting_names & deck.keys()}
+    if isinstance(overrides.get("compress_type"), str):
+        overrides["compress_type"] = ZLIB_STRATEGIES[overrides["compress_type"]]
+    if "colors" in deck:
+        deck["colors"] = tuple(Color[name.upper()] for name in deck["colors"])
+    if "shape_types" in deck:
+        deck["shape_types"] = tuple(ShapeType[name.upper()] for name in deck["shape_types"])
+    if "novelty_assets" in deck:
+        deck["novelty_assets"] = tuple(deck["novelty_assets"])
+    if "sizes" in deck:
+        deck["sizes"] = tuple(deck["sizes"])
+    return DeckSpec(settings=replace(settings, **overrides), **deck)
+
+
+def load_deck_specs(path: str, settings: RenderSettings = DEFAULT_RENDER_SETTINGS) -> List[DeckSpec]:
+    # a JSON file of {"decks": [...]}, each deck as deck_spec_from_dict takes it
+    with open(path) as f:
+        return [deck_spec_from_dict(deck, settings) for deck in json.load(f)["decks"]]
 
 
 def main():
-    legal_shape_layouts = dedupe_rotational_symmetry(filter_illegal(get_all_products()))
-    print(len(legal_shape_layouts))
-
-    #legal_shape_layouts = [(ShapeType.CORNER, ShapeType.CORNER, ShapeType.CORNER, ShapeType.CORNER)]
-    #colors = [Color.RED, Color.ORANGE, Color.YELLOW, Color.GREEN, Color.BLUE, Color.PURPLE, Color.PINK, Color.BLACK]
-    colors = [Color.RED, Color.YELLOW, Color.GREEN, Color.BLUE]
-    path_tiles = gen_starting_tiles(colors)
-    path_tiles_wout_tee = path_tiles
-    for shapes in legal_shape_layouts:
-        pattern = TilePattern(shapes)
-        new_tiles = pattern.generate_colored(colors)
-        for tile in new_tiles:
-            print(str(tile))
-        path_tiles = path_tiles + new_tiles
-        if shapes[0] != ShapeType.TEE and shapes[1] != ShapeType.TEE:
-            path_tiles_wout_tee = path_tiles_wout_tee + new_tiles
-
-    tiles = path_tiles + gen_novelty_tiles(len(colors), False)
-    out_dir = "tilesA"
-    draw_tiles(tiles, out_dir)
-
-    tiles = path_tiles_wout_tee + gen_novelty_tiles(len(colors), True)
-    out_dir = "tilesB"
-    draw_tiles(tiles, out_dir)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate the tile decks")
+    parser.add_argument("spec", nargs="?",
+                        help="JSON file describing the decks to build, instead of the default tilesA and tilesB")
+    parser.add_argument("--workers", type=int, help="drawing processes, by default one per CPU")
+    parser.add_argument("--count", action="store_true", help="only print how many tiles each deck has")
+    parser.add_argument("--list", action="store_true",
+                        help="only print each deck's layouts and how many colorings each has")
+    parser.add_argument("--cache-dir", default=ENUMERATION_CACHE_DIR,
+                        help="where enumerated layouts are kept between runs, an empty string for nowhere")
+    parser.add_argument("--stats", action="store_true", help="print a timing and cache summary when done")
+    parser.add_argument("--trace", help="write a Chrome trace-event JSON file of the build")
+    parser.add_argument("--compress-level", type=int, choices=range(10), help="zlib compression level")
+    parser.add_argument("--compress-type", choices=sorted(ZLIB_STRATEGIES), help="zlib compression strategy")
+    parser.add_argument("--palette", action="store_true", help="write palette images instead of RGBA")
+    parser.add_argument("--writers", type=int, default=0,
+                        help="threads per drawing process that encode and write tiles")
+    parser.add_argument("--incremental", action="store_true",
+                        help="keep each deck's output and only redraw tiles that changed since the last build")
+    parser.add_argument("--px", type=int, default=PX_PER_TILE, help="tile size in pixels")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[],
+                        help="smaller tile sizes the default decks also write, scaled down from the --px tiles")
+    args = parser.parse_args()
+    instrumentation.enabled = args.stats or args.trace is not None
+    # the size and encoder flags apply to every deck that doesn't set them itself
+    settings = RenderSettings(px_per_tile=args.px, compress_level=args.compress_level,
+                              compress_type=ZLIB_STRATEGIES.get(args.compress_type), palette=args.palette)
+
+    if args.spec:
+        specs = load_deck_specs(args.spec, settings)
+    else:
+        specs = [replace(spec, settings=settings, sizes=tuple(args.sizes)) for spec in DEFAULT_DECKS]
+
+    if args.count or args.list:
+        for spec in specs:
+            print(f'{spec.out_dir}: {count_tiles(spec, args.cache_dir)}')
+            if args.list:
+                for layout, colorings in zip(*deck_enumeration(spec.shape_types, spec.colors, args.cache_dir)):
+                    print(f'  {" ".join(s.value for s in layout):<28} {colorings}')
+        return
+
+    generate_decks(specs, args.workers, args.writers, cache_dir=args.cache_dir, incremental=args.incremental)
+
+    if args.stats:
+        print(instrumentation.summary())
+    if args.trace:
+        instrumentation.write_trace(args.trace)
 
 
 if __name__ == "__main__":
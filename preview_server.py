@@ -0,0 +1,253 @@
+#!/usr/local/bin/python3
+
+# Renders tiles on request, for previewing layouts and colors without building a whole deck:
+#   ./preview_server.py --port 8000
+#   http://localhost:8000/tile?layout=corner,corner,blank,blank&colors=red
+#   http://localhost:8000/tile?layout=line,line,line,line&colors=red,blue&px=600&supersample=4
+#   http://localhost:8000/tile?layout=line,line,line,line&colors=red&line_width_pct=0.1
+#   http://localhost:8000/novelty?asset=star.png
+#   http://localhost:8000/sheet?colors=red,green&layout=corner,corner,corner,corner&columns=3
+# A tile's colors are given one per shape, in the order TilePattern finds them (clockwise from the
+# top), or as a single color for all of them. A sheet has every coloring of the layout in colors, or
+# of every layout when none is given. Encoded images are kept in an LRU bounded by PREVIEW_CACHE_BYTES.
+import argparse
+import copy
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import chain, islice
+from urllib.parse import parse_qs, urlparse
+
+from generate_tiles import *
+
+PREVIEW_CACHE_BYTES = 64 * 1024 * 1024
+# a sheet's tiles, a tile's size and a sheet's size are capped so a request can't ask for an
+# arbitrarily large image
+MAX_SHEET_TILES = 400
+MAX_PREVIEW_PX = 4096
+MAX_SHEET_PIXELS = 64 * 1024 * 1024
+
+
+class PngCache:
+    # An LRU of encoded PNGs holding at most max_bytes of them. Each key is only rendered once even
+    # when several requests want it at the same time: the later ones wait on the first one's future.
+    def __init__(self, max_bytes: int = PREVIEW_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Tuple, render: Callable[[], Future]) -> bytes:
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return data
+            future = self.pending.get(key)
+            rendering = future is None
+            if rendering:
+                self.misses += 1
+                future = self.pending[key] = render()
+
+        try:
+            data = future.result()
+        finally:
+            if rendering:
+                with self.lock:
+                    del self.pending[key]
+        if rendering:
+            self._add(key, data)
+        return data
+
+    def _add(self, key: Tuple, data: bytes):
+        with self.lock:
+            self.entries[key] = data
+            self.size += len(data)
+            # the newest entry stays even if it's bigger than the whole cache
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+
+def render_tile_png(tile: Tile, settings: RenderSettings) -> bytes:
+    return encode_png(render_tile(tile, settings), settings)
+
+
+def render_sheet_png(tiles: List[Tile], columns: int, settings: RenderSettings) -> bytes:
+    rows = max(1, math.ceil(len(tiles) / columns))
+    sheet, _ = render_sheet(tiles, columns, rows, settings=settings)
+    return encode_png(sheet, settings)
+
+
+def _list(query: dict, name: str) -> List[str]:
+    return [value for value in query.get(name, "").split(",") if value]
+
+
+def _settings(query: dict) -> RenderSettings:
+    settings = RenderSettings(px_per_tile=int(query.get("px", PX_PER_TILE)),
+                              supersample=int(query.get("supersample", 1)),
+                              palette=query.get("palette", "") in ("1", "true"),
+                              line_width_pct=float(query.get("line_width_pct", LINE_WIDTH_PCT)))
+    # tiles can be drawn at any size from 1px, the label's font never going below 1pt
+    if not 0 < settings.px_per_tile <= settings.canvas_px <= MAX_PREVIEW_PX:
+        raise ValueError(f'tiles are drawn at 1 to {MAX_PREVIEW_PX}px, supersampling included')
+    if not 0 < settings.line_width_pct <= 1:
+        raise ValueError("line_width_pct is a fraction of the tile, above 0 and at most 1")
+    return settings
+
+
+# with unique set, repeats are dropped: a sheet's colors are a set to color from, while a tile's are
+# given one per shape
+def _colors(query: dict, unique: bool = False) -> List[Color]:
+    colors = [Color[name.upper()] for name in _list(query, "colors")]
+    if unique:
+        colors = list(dict.fromkeys(colors))
+    if not colors:
+        raise ValueError("colors is required")
+    return colors
+
+
+def _layout(query: dict) -> tuple:
+    layout = tuple(ShapeType[name.upper()] for name in _list(query, "layout"))
+    if len(layout) != 4 or not filter_illegal([layout]):
+        raise ValueError(f'{query.get("layout")} isn\'t a legal layout')
+    return layout
+
+
+# Each route turns a request's query into the cache key for its image and the call that renders it.
+# Keys hold the parsed request rather than the raw query, so equivalent URLs share an entry.
+def tile_route(query: dict) -> Tuple[Tuple, Tuple]:
+    layout = _layout(query)
+    colors = _colors(query)
+    settings = _settings(query)
+    shapes = [copy.copy(s) for s in TilePattern(layout).shapes]
+    colorable = [s for s in shapes if s.colorable]
+    if len(colors) == 1:
+        colors = colors * len(colorable)
+    if len(colors) != len(colorable):
+        raise ValueError(f'the layout has {len(colorable)} shapes to color, not {len(colors)}')
+    for shape, color in zip(colorable, colors):
+        shape.set_color(color)
+    tile = PathTile(shapes)
+    return ("tile", tile.render_key, settings), (render_tile_png, tile, settings)
+
+
+def novelty_route(query: dict) -> Tuple[Tuple, Tuple]:
+    asset = query.get("asset", "")
+    if asset not in os.listdir("assets"):
+        raise ValueError(f'no asset named "{asset}"')
+    tile = NoveltyTile(f'assets/{asset}')
+    settings = _settings(query)
+    return ("novelty", tile.render_key, settings), (render_tile_png, tile, settings)
+
+
+def sheet_route(query: dict) -> Tuple[Tuple, Tuple]:
+    colors = _colors(query, unique=True)
+    layouts = [_layout(query)] if "layout" in query else enumerate_layouts()
+    columns = int(query.get("columns", 10))
+    settings = _settings(query)
+    # counted before any tile is made, so a request for too many costs next to nothing to turn down
+    patterns = [TilePattern(layout) for layout in layouts]
+    count = sum(pattern.coloring_count(len(colors)) for pattern in patterns)
+    if columns < 1 or count > MAX_SHEET_TILES:
+        raise ValueError(f'a sheet holds 1 to {MAX_SHEET_TILES} tiles, not {count}')
+    tiles = list(islice(chain.from_iterable(pattern.generate_colored(colors) for pattern in patterns),
+                        MAX_SHEET_TILES))
+    # more columns than tiles would only add empty paper
+    columns = min(columns, len(tiles))
+    rows = max(1, math.ceil(len(tiles) / columns))
+    if columns * settings.px_per_tile * rows * settings.px_per_tile > MAX_SHEET_PIXELS:
+        raise ValueError(f'a {columns}x{rows} sheet of {settings.px_per_tile}px tiles is over '
+                         f'{MAX_SHEET_PIXELS} pixels')
+    key = ("sheet", tuple(tile.render_key for tile in tiles), columns, settings)
+    return key, (render_sheet_png, tiles, columns, settings)
+
+
+ROUTES = {
+    "/tile": tile_route,
+    "/novelty": novelty_route,
+    "/sheet": sheet_route,
+}
+
+
+class PreviewServer(ThreadingHTTPServer):
+    # Requests are handled on a thread each, while rendering happens on a pool of worker processes
+    # (or a single thread with workers=1) shared by all of them
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], workers: int = None, cache_bytes: int = PREVIEW_CACHE_BYTES):
+        super().__init__(address, PreviewHandler)
+        workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else ThreadPoolExecutor(1)
+        self.cache = PngCache(cache_bytes)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(cancel_futures=True)
+
+
+class PreviewHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if url.path == "/stats":
+            self._send(200, "application/json", json.dumps(self.server.cache.stats()).encode())
+            return
+
+        route = ROUTES.get(url.path)
+        if route is None:
+            self.send_error(404)
+            return
+        try:
+            key, job = route(query)
+        except (KeyError, ValueError) as e:
+            self.send_error(400, f'bad request: {e}')
+            return
+        try:
+            data = self.server.cache.get(key, lambda: self.server.executor.submit(*job))
+        except Exception as e:
+            self.send_error(500, f'rendering failed: {e}')
+            return
+        self._send(200, "image/png", data)
+
+    def _send(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve tiles rendered on request")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, help="rendering processes, by default one per CPU")
+    parser.add_argument("--cache-mb", type=int, default=PREVIEW_CACHE_BYTES // (1024 * 1024),
+                        help="how much encoded PNG data to keep")
+    args = parser.parse_args()
+
+    server = PreviewServer((args.host, args.port), args.workers, args.cache_mb * 1024 * 1024)
+    print(f'serving on http://{args.host}:{server.server_port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+import contextlib
+import io
+from unittest import TestCase
+
+from bench_generate_tiles import *
+
+
+class TestBench(TestCase):
+    def test_run(self):
+        current = run([2], [40], 1)
+        self.assertIn("generate_colored[colors=2]", current["results"])
+        self.assertIn("draw_tiles[colors=2, px=40]", current["results"])
+        self.assertTrue(all(seconds > 0 for seconds in current["results"].values()))
+        # has to survive the round trip through --output
+        json.dumps(current)
+
+    def test_compare(self):
+        baseline = {"results": {"a": 1.0, "b": 1.0, "gone": 1.0}}
+        current = {"results": {"a": 1.1, "b": 1.5, "new": 1.0}}
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(["b"], compare(baseline, current, 1.2))
@@ -0,0 +1,106 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from edge_index import *
+from generate_tiles import *
+
+
+class TestEdgeIndexBuilder(TestCase):
+    def test_round_trip(self):
+        red, blue = (255, 0, 0, 255), (0, 0, 255, 255)
+        builder = EdgeIndexBuilder()
+        builder.add([("line", red), ("blank", None), ("line", red), ("blank", None)])
+        builder.add(None)
+        builder.add([("nub", blue)] * 4)
+        with tempfile.TemporaryDirectory() as tmp:
+            builder.write(f'{tmp}/{EDGE_INDEX_NAME}')
+            self.assertEqual([EDGE_INDEX_NAME], os.listdir(tmp))
+            index = EdgeIndex(f'{tmp}/{EDGE_INDEX_NAME}')
+        self.assertEqual(3, index.tile_count)
+        self.assertEqual(["line", "blank", "nub"], index.shape_types)
+        self.assertEqual([red, blue], index.colors)
+        self.assertEqual(edge_key(2, 2), index.edge_key("nub", blue))
+        self.assertEqual(pack_connectors([edge_key(0, 1), edge_key(1, 0)] * 2, 1), index.connectors(0, 1))
+        self.assertEqual(0, index.connectors(1))
+        self.assertEqual([(0, 1), (0, 3)], index.tiles_with_color(0))
+        # a blank side meets a blank side, whichever way round the line is
+        self.assertEqual([(0, 0), (0, 2)], sorted(index.neighbors(0, 1)))
+
+    def test_too_many_colors(self):
+        builder = EdgeIndexBuilder()
+        with self.assertRaises(ValueError):
+            for i in range(EDGE_COLOR_MASK + 1):
+                builder.add([("nub", (i, 0, 0, 255))] * 4)
+
+    def test_not_an_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(f'{tmp}/x.bin', "wb") as f:
+                f.write(b"\0" * 64)
+            with self.assertRaises(ValueError):
+                EdgeIndex(f'{tmp}/x.bin')
+
+
+class TestEdgeIndex(TestCase):
+    def _tile(self) -> PathTile:
+        corner = Corner([top_pt, right_pt], PX_PER_TILE)
+        corner.set_color(Color.RED)
+        nub = Nub(bot_pt, PX_PER_TILE)
+        nub.set_color(Color.BLUE)
+        return PathTile([corner, nub])
+
+    def _index(self, tiles: List[Tile]) -> EdgeIndex:
+        builder = EdgeIndexBuilder()
+        self.assertEqual(tiles, list(track_edges(tiles, builder)))
+        with tempfile.TemporaryDirectory() as tmp:
+            builder.write(f'{tmp}/{EDGE_INDEX_NAME}')
+            return EdgeIndex(f'{tmp}/{EDGE_INDEX_NAME}')
+
+    def test_sides(self):
+        tile = self._tile()
+        self.assertEqual([(ShapeType.CORNER, Color.RED), (ShapeType.CORNER, Color.RED),
+                          (ShapeType.NUB, Color.BLUE), (ShapeType.BLANK, None)], tile_sides(tile))
+        self.assertIsNone(tile_sides(NoveltyTile("assets/star.png")))
+
+    def test_connectors(self):
+        tile = self._tile()
+        index = self._index([NoveltyTile("assets/star.png"), tile])
+        self.assertEqual(2, index.tile_count)
+        self.assertEqual([Color.RED.value, Color.BLUE.value], index.colors)
+        self.assertEqual(["corner", "nub", "blank"], index.shape_types)
+        self.assertEqual(0, index.connectors(0, 1))
+
+        red_corner = index.edge_key(ShapeType.CORNER, Color.RED)
+        blank = index.edge_key(ShapeType.BLANK)
+        self.assertEqual([red_corner, red_corner, index.edge_key(ShapeType.NUB, Color.BLUE), blank],
+                         [index.side_key(1, side) for side in range(4)])
+        # turned a quarter clockwise, the blank side comes round to the top
+        self.assertEqual(blank, index.side_key(1, 0, rotation=1))
+        self.assertEqual(red_corner, index.side_key(1, 2, rotation=1))
+        self.assertEqual([(1, 0), (1, 1)], index.tiles_with_edge(red_corner))
+
+    def test_neighbors_match_color_across_shapes(self):
+        line = Line([left_pt, right_pt], PX_PER_TILE)
+        line.set_color(Color.RED)
+        index = self._index([self._tile(), PathTile([line])])
+        # the corner's red right side takes the line's red left side, unrotated or turned half way, as
+        # well as the corner's own red sides
+        self.assertEqual([(0, 2), (0, 3), (1, 0), (1, 2)], sorted(index.neighbors(0, 1)))
+        # and its blank left side takes the line's blank top or bottom, turned a quarter
+        self.assertEqual([(0, 2), (1, 1), (1, 3)], sorted(index.neighbors(0, 3)))
+
+    def test_neighbors_match_brute_force(self):
+        tiles = list(chain(gen_path_tiles(enumerate_layouts(), [Color.RED, Color.GREEN]),
+                           gen_asset_tiles(["star.png"], 1)))
+        index = self._index(tiles)
+        sides = [tile_sides(tile) for tile in tiles]
+        for tile_id in (0, 5, 12, len(tiles) - 1):
+            for side, rotation in product(range(4), range(4)):
+                expected = []
+                if sides[tile_id] is not None:
+                    # sides meet when their colors do, whatever the shapes
+                    color = sides[tile_id][(side - rotation) % 4][1]
+                    expected = sorted((other, other_rotation) for other in range(len(tiles))
+                                      for other_rotation in range(4) if sides[other] is not None and
+                                      sides[other][(side + 2 - other_rotation) % 4][1] == color)
+                self.assertEqual(expected, sorted(index.neighbors(tile_id, side, rotation)))
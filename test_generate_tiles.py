@@ -1,3 +1,12 @@
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+
+from PIL import ImageChops
+
+import generate_tiles
 from unittest import TestCase
 
 from generate_tiles import *
@@ -11,6 +20,72 @@ class Test(TestCase):
         unduped = dedupe_rotational_symmetry(dupe_list)
         self.assertEqual([(ShapeType.NUB, ShapeType.NUB, ShapeType.BLANK, ShapeType.BLANK)], unduped)
 
+    def test_dedupe_keeps_first_seen_order(self):
+        dupe_list = [
+            (ShapeType.LINE, ShapeType.BLANK, ShapeType.LINE, ShapeType.BLANK),
+            (ShapeType.CORNER, ShapeType.CORNER, ShapeType.BLANK, ShapeType.BLANK),
+            (ShapeType.BLANK, ShapeType.LINE, ShapeType.BLANK, ShapeType.LINE),
+            (ShapeType.BLANK, ShapeType.CORNER, ShapeType.CORNER, ShapeType.BLANK),
+        ]
+        self.assertEqual(dupe_list[:2], dedupe_rotational_symmetry(dupe_list))
+
+    def test_dedupe_reflection(self):
+        dupe_list = [
+            (ShapeType.NUB, ShapeType.CORNER, ShapeType.CORNER, ShapeType.BLANK),
+            (ShapeType.BLANK, ShapeType.CORNER, ShapeType.CORNER, ShapeType.NUB),
+        ]
+        # mirror images aren't rotations of one another
+        self.assertEqual(dupe_list, dedupe_rotational_symmetry(dupe_list))
+        self.assertEqual(dupe_list[:1], dedupe_rotational_symmetry(dupe_list, reflect=True))
+
+    def test_dedupe_hexagonal(self):
+        dupe_list = [
+            (ShapeType.NUB, ShapeType.BLANK, ShapeType.BLANK, ShapeType.LINE, ShapeType.BLANK, ShapeType.BLANK),
+            (ShapeType.BLANK, ShapeType.BLANK, ShapeType.NUB, ShapeType.BLANK, ShapeType.BLANK, ShapeType.LINE),
+            (ShapeType.BLANK, ShapeType.NUB, ShapeType.BLANK, ShapeType.LINE, ShapeType.BLANK, ShapeType.BLANK),
+        ]
+        self.assertEqual([dupe_list[0], dupe_list[2]], dedupe_rotational_symmetry(dupe_list))
+
+
+class TestFilterIllegal(TestCase):
+    def test_vectorized_matches(self):
+        products = get_all_products()
+        self.assertEqual(filter_illegal(products), filter_illegal_vectorized(products))
+
+    def test_vectorized_matches_with_nubs(self):
+        products = list(product(list(ShapeType), repeat=4))
+        self.assertEqual(filter_illegal(products), filter_illegal_vectorized(products))
+
+    def test_vectorized_empty(self):
+        self.assertEqual([], filter_illegal_vectorized([]))
+
+    def test_vectorized_rejects_other_side_counts(self):
+        hexagons = list(product([ShapeType.LINE, ShapeType.BLANK], repeat=6))
+        with self.assertRaises(ValueError):
+            filter_illegal_vectorized(hexagons)
+        with self.assertRaises(ValueError):
+            encode_layouts(hexagons[:1] + get_all_products()[:1])
+        with self.assertRaises(ValueError):
+            legal_layout_mask(encode_layouts(get_all_products())[:, :3])
+
+
+class TestConstructLayouts(TestCase):
+    def _filtered(self, shape_types):
+        return dedupe_rotational_symmetry(filter_illegal(get_all_products(shape_types)))
+
+    def test_matches_filtered_product(self):
+        self.assertEqual(self._filtered(DEFAULT_SHAPE_TYPES), construct_layouts())
+
+    def test_matches_filtered_product_with_nubs(self):
+        shape_types = list(ShapeType)
+        self.assertEqual(self._filtered(shape_types), construct_layouts(shape_types))
+
+    def test_follows_alphabet_order(self):
+        shape_types = (ShapeType.TEE, ShapeType.NUB, ShapeType.BLANK, ShapeType.CORNER)
+        layouts = construct_layouts(shape_types)
+        self.assertEqual(self._filtered(shape_types), layouts)
+        self.assertEqual((ShapeType.TEE, ShapeType.TEE, ShapeType.TEE, ShapeType.NUB), layouts[0])
+
 
 class TestShape(TestCase):
     def test_eq_corner(self):
@@ -50,6 +125,48 @@ class TestColoredTile(TestCase):
         self.assertEqual(tile3, tile4)
         self.assertNotEqual(tile3, tile5)
 
+    def test_codes_round_trip(self):
+        corner = Corner([top_pt, right_pt], PX_PER_TILE)
+        corner.set_color(Color.BLUE)
+        tile = PathTile([corner, Blank(), Nub(left_pt, PX_PER_TILE)])
+        self.assertTrue(all(isinstance(c, int) for c in tile.codes))
+        self.assertFalse(hasattr(tile, '__dict__'))
+        self.assertFalse(hasattr(corner, '__dict__'))
+        self.assertEqual(["corner [(0.5, 0), (1, 0.5)] Color.BLUE", "blank None Color.WHITE",
+                          "nub (0, 0.5) Color.WHITE"], [str(s) for s in tile.shapes])
+        self.assertEqual(("path", ("corner", (top_pt, right_pt), Color.BLUE.value),
+                          ("blank", None, Color.WHITE.value), ("nub", left_pt, Color.WHITE.value)),
+                         tile.render_key)
+
+    def test_pickles_as_shapes(self):
+        tile = next(TilePattern((ShapeType.CORNER, ShapeType.CORNER, ShapeType.NUB, ShapeType.BLANK))
+                    .generate_colored([Color.PINK]))
+        unpickled = pickle.loads(pickle.dumps(tile))
+        self.assertEqual(tile, unpickled)
+        self.assertEqual(tile.render_key, unpickled.render_key)
+
+    def test_codes_from_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        # shapes and colors no other test interns, each encoded by every thread at once
+        shapes = []
+        for i in range(64):
+            nub = Nub(left_pt, 20000 + i)
+            nub.color = (i % 4, 1, 2, 255)
+            shapes.append(nub)
+        start = threading.Barrier(8)
+
+        def encode(_):
+            start.wait()
+            return [encode_shape(shape) for shape in shapes]
+
+        with ThreadPoolExecutor(8) as executor:
+            codes = list(executor.map(encode, range(8)))
+        self.assertTrue(all(c == codes[0] for c in codes))
+        self.assertEqual(len(shapes), len(set(codes[0])))
+        self.assertEqual([(s.canvas_px, s.color) for s in shapes],
+                         [(decode_shape(c).canvas_px, decode_shape(c).color) for c in codes[0]])
+
 
 class TestTilePattern(TestCase):
     def test_generate_colored(self):
@@ -62,3 +179,567 @@ class TestTilePattern(TestCase):
         generated = tile1.generate_colored([Color.RED, Color.GREEN])
         expected = [PathTile([blank, blank, blank, green_right_nub]), PathTile([blank, blank, blank, red_right_nub])]
         self.assertCountEqual(generated, expected)
+
+    def test_generate_colored_matches_full_product(self):
+        colors = [Color.RED, Color.ORANGE, Color.YELLOW, Color.GREEN, Color.BLUE, Color.PURPLE, Color.PINK,
+                  Color.BLACK]
+        pattern = TilePattern((ShapeType.NUB, ShapeType.NUB, ShapeType.NUB, ShapeType.NUB))
+        generated = list(pattern.generate_colored(colors))
+
+        # dicts keep first-seen order, which is the order the generator is expected to follow
+        expected = {}
+        for coloring in product(colors, repeat=4):
+            shapes = [copy.copy(s) for s in pattern.shapes]
+            for shape, color in zip(shapes, coloring):
+                shape.set_color(color)
+            tile = PathTile(shapes)
+            expected.setdefault(tile, tile)
+
+        # 8 multichoose 4
+        self.assertEqual(330, len(generated))
+        self.assertEqual([str(t) for t in expected], [str(t) for t in generated])
+
+    def test_coloring_count(self):
+        for layout in enumerate_layouts(tuple(ShapeType)):
+            pattern = TilePattern(layout)
+            for colors in [[Color.RED], [Color.RED, Color.GREEN, Color.BLUE]]:
+                self.assertEqual(len(list(pattern.generate_colored(colors))), pattern.coloring_count(len(colors)))
+
+    def test_generate_colored_is_lazy(self):
+        pattern = TilePattern((ShapeType.CORNER, ShapeType.CORNER, ShapeType.BLANK, ShapeType.BLANK))
+        generated = pattern.generate_colored([Color.RED, Color.GREEN])
+        self.assertIsInstance(next(generated), PathTile)
+
+
+class TestResourceCache(TestCase):
+    def test_novelty_asset_loaded_once(self):
+        load_asset.cache_clear()
+        load_font.cache_clear()
+        for tile in gen_novelty_tiles(3, False):
+            tile.draw(Image.new('RGBA', (PX_PER_TILE, PX_PER_TILE), Color.LIGHT_GREY.value))
+
+        # flip.png and rotate.png, each drawn 3 times
+        self.assertEqual(2, load_asset.cache_info().misses)
+        self.assertEqual(4, load_asset.cache_info().hits)
+        self.assertEqual(1, load_font.cache_info().misses)
+        self.assertEqual(5, load_font.cache_info().hits)
+
+    def test_cache_is_bounded(self):
+        load_asset.cache_clear()
+        for size in range(1, RESOURCE_CACHE_SIZE + 5):
+            load_asset("assets/star.png", (size, size))
+        self.assertEqual(RESOURCE_CACHE_SIZE, load_asset.cache_info().currsize)
+
+
+class TestShapeStamp(TestCase):
+    def test_stamps_match_vector_drawing(self):
+        layouts = [(ShapeType.NUB, ShapeType.NUB, ShapeType.NUB, ShapeType.NUB)] + \
+            dedupe_rotational_symmetry(filter_illegal(get_all_products()))
+        colors = [Color.RED, Color.BLUE]
+        for tile in gen_path_tiles(layouts, colors):
+            for canvas_px in [PX_PER_TILE, 97, 1200]:
+                vector = Image.new('RGBA', (canvas_px, canvas_px), Color.LIGHT_GREY.value)
+                drawer = ImageDraw.Draw(vector)
+                for shape in tile.shapes:
+                    shape.draw(drawer, canvas_px=canvas_px)
+                stamped = Image.new('RGBA', (canvas_px, canvas_px), Color.LIGHT_GREY.value)
+                for shape in tile.shapes:
+                    for mask, offset in shape.stamp(canvas_px):
+                        stamped.paste(shape.color.value, offset + tuple_offset(offset, mask.size), mask)
+                self.assertEqual(vector.tobytes(), stamped.tobytes(), str(tile))
+
+    def test_stamps_are_shared(self):
+        shape_stamp.cache_clear()
+        pattern = TilePattern((ShapeType.CORNER, ShapeType.CORNER, ShapeType.CORNER, ShapeType.CORNER))
+        for tile in pattern.generate_colored([Color.RED, Color.GREEN, Color.BLUE]):
+            tile.draw(Image.new('RGBA', (PX_PER_TILE, PX_PER_TILE), Color.LIGHT_GREY.value))
+        self.assertEqual(2, shape_stamp.cache_info().currsize)
+
+
+class TestRenderTile(TestCase):
+    def _tiles(self):
+        layouts = [(ShapeType.CORNER, ShapeType.CORNER, ShapeType.CORNER, ShapeType.CORNER),
+                   (ShapeType.TEE, ShapeType.TEE, ShapeType.TEE, ShapeType.BLANK)]
+        return list(chain(gen_path_tiles(layouts, [Color.RED, Color.BLUE]), gen_novelty_tiles(1, True)))
+
+    def test_default_matches_draw(self):
+        for tile in self._tiles():
+            background = Image.new('RGBA', (PX_PER_TILE, PX_PER_TILE), Color.LIGHT_GREY.value)
+            self.assertEqual(tile.draw(background).tobytes(), render_tile(tile).tobytes())
+
+    def test_supersample_anti_aliases(self):
+        tile = self._tiles()[0]
+        aliased = render_tile(tile, RenderSettings(px_per_tile=150))
+        smoothed = render_tile(tile, RenderSettings(px_per_tile=150, supersample=4))
+        self.assertEqual((150, 150), smoothed.size)
+        self.assertGreater(len(smoothed.getcolors(150 * 150)), len(aliased.getcolors(150 * 150)))
+
+    def test_strips_match_whole_tile(self):
+        for tile in self._tiles():
+            whole = render_tile(tile, RenderSettings(px_per_tile=120, supersample=3))
+            strips = render_tile(tile, RenderSettings(px_per_tile=120, supersample=3, strip_px=25))
+            self.assertEqual(whole.tobytes(), strips.tobytes())
+        # the scratch buffer only ever holds one strip
+        self.assertEqual([(360, 75)], list(generate_tiles._scratch))
+
+    def test_label_scales(self):
+        def label_size(px: int) -> Tuple[int, int]:
+            im = render_tile(self._tiles()[0], RenderSettings(px_per_tile=px))
+            label = im.crop(tuple_multiply((0, 0.8, 0.3, 1), px))
+            # channels that are fully on, then pixels where all of them are
+            saturated = label.convert('RGB').point(lambda v: 255 if v == 255 else 0)
+            bbox = saturated.convert('L').point(lambda v: 255 if v == 255 else 0).getbbox()
+            return bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+        small = label_size(300)
+        large = label_size(900)
+        self.assertAlmostEqual(3, large[0] / small[0], delta=0.2)
+        self.assertAlmostEqual(3, large[1] / small[1], delta=0.2)
+
+
+class TestRasterizeTiles(TestCase):
+    def _tiles(self):
+        # every layout, so lines cross, tees overlap and corners sit next to the label
+        return list(chain(gen_path_tiles(enumerate_layouts(), [Color.RED, Color.BLUE]),
+                          gen_novelty_tiles(1, True)))
+
+    def _check(self, settings: RenderSettings):
+        tiles = self._tiles()
+        pixels = rasterize_tiles(tiles, settings)
+        self.assertEqual((len(tiles), settings.px_per_tile, settings.px_per_tile, 4), pixels.shape)
+        for tile, tile_pixels in zip(tiles, pixels):
+            self.assertEqual(render_tile(tile, settings).tobytes(), tile_pixels.tobytes())
+
+    def test_matches_render_tile(self):
+        self._check(RenderSettings(px_per_tile=96))
+
+    def test_supersampled_matches_render_tile(self):
+        self._check(RenderSettings(px_per_tile=60, supersample=3))
+        self._check(RenderSettings(px_per_tile=40, supersample=4))
+
+    def test_line_width(self):
+        settings = RenderSettings(px_per_tile=80, supersample=2, line_width_pct=0.15)
+        self._check(settings)
+        self.assertNotEqual(render_params(settings), render_params(replace(settings, line_width_pct=LINE_WIDTH_PCT)))
+
+    def test_empty(self):
+        self.assertEqual((0, 32, 32, 4), rasterize_tiles([], RenderSettings(px_per_tile=32)).shape)
+
+    def test_label_too_small_to_draw(self):
+        # below 10px the label covers no pixel at all
+        for px in (5, 9, 10):
+            self._check(RenderSettings(px_per_tile=px))
+        self._check(RenderSettings(px_per_tile=3, supersample=2))
+        # and below 5px the font would round down to 0pt
+        for px in range(1, 5):
+            self._check(RenderSettings(px_per_tile=px))
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertEqual(2, draw_tiles(self._tiles()[:2], tmp, settings=RenderSettings(px_per_tile=6)))
+
+    def test_batch_allocation_bounded(self):
+        import tracemalloc
+
+        tiles = self._tiles()
+        for settings in [RenderSettings(px_per_tile=300), RenderSettings(px_per_tile=1200),
+                         RenderSettings(px_per_tile=300, supersample=4)]:
+            count = raster_batch_size(settings)
+            self.assertTrue(0 < count <= RASTER_BATCH_SIZE, settings)
+            rasterize_tiles(tiles[:1], settings)
+            tracemalloc.start()
+            try:
+                rasterize_tiles(tiles[:count], settings)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertLessEqual(peak, raster_batch_bytes(settings, count), settings)
+            self.assertLessEqual(raster_batch_bytes(settings, count), RASTER_BATCH_BYTES)
+        # a tile this size doesn't fit on its own, so it's left to render_tile
+        self.assertEqual(0, raster_batch_size(RenderSettings(px_per_tile=1200, supersample=4)))
+
+    def test_draw_tiles_in_strips(self):
+        # strip_px keeps drawing tiles one at a time, and both ways write the same images
+        tiles = self._tiles()[:RASTER_BATCH_SIZE + 3]
+        with tempfile.TemporaryDirectory() as tmp:
+            draw_tiles(tiles, f'{tmp}/batch', settings=RenderSettings(px_per_tile=48, supersample=2))
+            draw_tiles(tiles, f'{tmp}/strips', settings=RenderSettings(px_per_tile=48, supersample=2, strip_px=16))
+            for i in range(len(tiles)):
+                self.assertEqual(file_digest(f'{tmp}/batch/{i}.png'), file_digest(f'{tmp}/strips/{i}.png'))
+
+
+class TestDrawTiles(TestCase):
+    def test_no_workers_rejected(self):
+        tiles = list(gen_path_tiles([(ShapeType.CORNER,) * 4], [Color.RED]))
+        with tempfile.TemporaryDirectory() as tmp:
+            write_file(f'{tmp}/keep', b"")
+            for workers, batch_size in [(0, None), (-1, None), (1, 0)]:
+                with self.assertRaises(ValueError):
+                    draw_tiles(tiles, tmp, workers=workers, batch_size=batch_size)
+            # turned down before out_dir was cleared
+            self.assertEqual(["keep"], os.listdir(tmp))
+
+    def test_parallel_matches_serial(self):
+        colors = [Color.RED, Color.GREEN]
+        layouts = [(ShapeType.CORNER, ShapeType.CORNER, ShapeType.BLANK, ShapeType.BLANK),
+                   (ShapeType.TEE, ShapeType.TEE, ShapeType.TEE, ShapeType.BLANK)]
+        tiles = list(chain(gen_path_tiles(layouts, colors), gen_novelty_tiles(1, True)))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            serial_dir = os.path.join(tmp, "serial")
+            parallel_dir = os.path.join(tmp, "parallel")
+            os.mkdir(serial_dir)
+            os.mkdir(parallel_dir)
+            draw_tiles(tiles, serial_dir)
+            draw_tiles(tiles, parallel_dir, workers=2)
+
+            self.assertEqual(sorted(os.listdir(serial_dir)), sorted(os.listdir(parallel_dir)))
+            self.assertEqual(len(tiles) + 1, len(os.listdir(serial_dir)))
+            for name in os.listdir(serial_dir):
+                with open(os.path.join(serial_dir, name), "rb") as a, \
+                        open(os.path.join(parallel_dir, name), "rb") as b:
+                    self.assertEqual(a.read(), b.read(), name)
+
+    def test_writers_match_serial(self):
+        colors = [Color.RED, Color.GREEN]
+        layouts = [(ShapeType.CORNER, ShapeType.CORNER, ShapeType.NUB, ShapeType.BLANK)]
+        tiles = list(chain(gen_path_tiles(layouts, colors), gen_novelty_tiles(1, False)))
+        with tempfile.TemporaryDirectory() as tmp:
+            draw_tiles(tiles, f'{tmp}/serial')
+            draw_tiles(tiles, f'{tmp}/threaded', writers=2)
+            for name in os.listdir(f'{tmp}/serial'):
+                with open(f'{tmp}/serial/{name}', "rb") as a, open(f'{tmp}/threaded/{name}', "rb") as b:
+                    self.assertEqual(a.read(), b.read(), name)
+
+    def test_palette_output(self):
+        tile = next(TilePattern((ShapeType.CORNER, ShapeType.CORNER, ShapeType.NUB, ShapeType.BLANK))
+                    .generate_colored([Color.PURPLE]))
+        settings = RenderSettings(palette=True, compress_level=9)
+        with tempfile.TemporaryDirectory() as tmp:
+            draw_tiles([tile], tmp, settings=settings)
+            with Image.open(f'{tmp}/0.png') as im:
+                self.assertEqual('P', im.mode)
+                written = im.convert('RGBA')
+
+        expected = render_tile(tile)
+        # the shapes and background are exact, only the label's anti-aliased edge is approximated
+        top_half = (0, 0, PX_PER_TILE, PX_PER_TILE // 2)
+        self.assertEqual(expected.crop(top_half).tobytes(), written.crop(top_half).tobytes())
+        diff = ImageChops.difference(expected, written)
+        self.assertLessEqual(max(high for _, high in diff.getextrema()), 8)
+
+    def test_streams_tiles(self):
+        colors = [Color.RED, Color.GREEN, Color.BLUE]
+        layouts = [(ShapeType.CORNER, ShapeType.CORNER, ShapeType.CORNER, ShapeType.CORNER)]
+        with tempfile.TemporaryDirectory() as tmp:
+            written_early = []
+
+            def tiles():
+                for i, tile in enumerate(gen_path_tiles(layouts, colors)):
+                    if i == 10:
+                        written_early.append(os.path.exists(f'{tmp}/0.png'))
+                    yield tile
+
+            draw_tiles(tiles(), tmp, batch_size=4)
+            self.assertEqual([True], written_early)
+            # 3 starters twice, plus 3 multichoose 2 corner pairs, and the manifest
+            self.assertEqual(13, len(os.listdir(tmp)))
+
+    def test_duplicates_rendered_once(self):
+        colors = [Color.RED, Color.GREEN]
+        tiles = list(chain(gen_starting_tiles(colors), gen_novelty_tiles(2, False)))
+        render_cache = RenderCache()
+        with tempfile.TemporaryDirectory() as tmp:
+            deck_a = os.path.join(tmp, "a")
+            deck_b = os.path.join(tmp, "b")
+            os.mkdir(deck_a)
+            os.mkdir(deck_b)
+            # one tile per batch, so most links point into an earlier batch
+            draw_tiles(iter(tiles), deck_a, render_cache=render_cache, batch_size=1)
+            draw_tiles(tiles[:2], deck_b, workers=2, render_cache=render_cache)
+
+            # 2 starters and 2 novelty images, each appearing twice
+            self.assertEqual(4, len(render_cache.paths))
+            for i, j in [(0, 1), (2, 3), (4, 5), (6, 7)]:
+                with open(f'{deck_a}/{i}.png', "rb") as a, open(f'{deck_a}/{j}.png', "rb") as b:
+                    self.assertEqual(a.read(), b.read())
+            self.assertTrue(os.path.samefile(f'{deck_a}/0.png', f'{deck_b}/0.png'))
+            self.assertTrue(os.path.samefile(f'{deck_a}/0.png', f'{deck_b}/1.png'))
+
+    def test_missing_out_dir(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            out_dir = os.path.join(tmp, "missing", "deck")
+            draw_tiles(gen_starting_tiles([Color.RED]), out_dir)
+            self.assertEqual(["0.png", "1.png", MANIFEST_NAME], sorted(os.listdir(out_dir)))
+
+    def test_incremental(self):
+        layouts = [(ShapeType.LINE, ShapeType.LINE, ShapeType.LINE, ShapeType.LINE)]
+        with tempfile.TemporaryDirectory() as tmp:
+            draw_tiles(gen_path_tiles(layouts, [Color.RED, Color.GREEN]), tmp, incremental=True)
+            # 2 starters twice, then red/red, red/green and green/green line pairs
+            self.assertEqual(7, len(load_manifest(tmp)))
+            mtimes = {name: os.stat(f'{tmp}/{name}').st_mtime_ns for name in load_manifest(tmp)}
+
+            # swapping green for blue keeps the red starters and the red/red lines
+            draw_tiles(gen_path_tiles(layouts, [Color.RED, Color.BLUE]), tmp, incremental=True)
+            manifest = load_manifest(tmp)
+            unchanged = [name for name in manifest if os.stat(f'{tmp}/{name}').st_mtime_ns == mtimes[name]]
+            self.assertEqual(["0.png", "1.png", "4.png"], unchanged)
+            for name, entry in manifest.items():
+                self.assertEqual(entry["output"], file_digest(f'{tmp}/{name}'))
+
+            with tempfile.TemporaryDirectory() as fresh:
+                draw_tiles(gen_path_tiles(layouts, [Color.RED, Color.BLUE]), fresh)
+                self.assertEqual(manifest, load_manifest(fresh))
+
+            # a smaller deck removes the files it no longer has
+            draw_tiles(gen_path_tiles(layouts, [Color.RED]), tmp, incremental=True)
+            self.assertEqual(["0.png", "1.png", "2.png", MANIFEST_NAME], sorted(os.listdir(tmp)))
+
+    def test_sizes(self):
+        layouts = [(ShapeType.TEE, ShapeType.TEE, ShapeType.TEE, ShapeType.BLANK)]
+        tiles = list(chain(gen_path_tiles(layouts, [Color.RED, Color.GREEN]), gen_novelty_tiles(1, True)))
+        settings = RenderSettings(px_per_tile=120, supersample=2)
+        with tempfile.TemporaryDirectory() as tmp:
+            draw_tiles(tiles, tmp, settings=settings, sizes=[30, 50])
+            self.assertEqual(sorted(["30px", "50px", MANIFEST_NAME] + [f'{i}.png' for i in range(len(tiles))]),
+                             sorted(os.listdir(tmp)))
+            for i, tile in enumerate(tiles):
+                # each size scaled down from the one above it
+                full = render_tile(tile, settings)
+                medium = full.resize((50, 50), Image.Resampling.BOX)
+                small = medium.resize((30, 30), Image.Resampling.BOX)
+                for path, expected in ((f'{i}.png', full), (f'50px/{i}.png', medium), (f'30px/{i}.png', small)):
+                    with Image.open(f'{tmp}/{path}') as im:
+                        self.assertEqual(expected.tobytes(), im.tobytes())
+            self.assertEqual(3 * len(tiles), len(load_manifest(tmp)))
+
+            # all sizes of a tile another deck (or only its full size) already has are linked
+            render_cache = RenderCache()
+            draw_tiles(tiles[:2], f'{tmp}/a', render_cache=render_cache, settings=settings)
+            draw_tiles(tiles[:2], f'{tmp}/b', render_cache=render_cache, settings=settings, sizes=[30])
+            self.assertTrue(os.path.samefile(f'{tmp}/a/1.png', f'{tmp}/b/1.png'))
+            draw_tiles(tiles[:2], f'{tmp}/c', render_cache=render_cache, settings=settings, sizes=[30])
+            self.assertTrue(os.path.samefile(f'{tmp}/b/30px/1.png', f'{tmp}/c/30px/1.png'))
+
+            with self.assertRaises(ValueError):
+                draw_tiles(tiles, tmp, settings=settings, sizes=[120])
+
+    def test_incremental_sizes(self):
+        layouts = [(ShapeType.LINE, ShapeType.LINE, ShapeType.LINE, ShapeType.LINE)]
+        settings = RenderSettings(px_per_tile=60)
+        with tempfile.TemporaryDirectory() as tmp:
+            draw_tiles(gen_path_tiles(layouts, [Color.RED]), tmp, incremental=True, settings=settings)
+            mtime = os.stat(f'{tmp}/0.png').st_mtime_ns
+            # adding a size leaves the full size files alone
+            draw_tiles(gen_path_tiles(layouts, [Color.RED]), tmp, incremental=True, settings=settings, sizes=[20])
+            self.assertEqual(mtime, os.stat(f'{tmp}/0.png').st_mtime_ns)
+            with tempfile.TemporaryDirectory() as fresh:
+                draw_tiles(gen_path_tiles(layouts, [Color.RED]), fresh, settings=settings, sizes=[20])
+                self.assertEqual(load_manifest(fresh), load_manifest(tmp))
+
+            # and dropping it again removes its files
+            draw_tiles(gen_path_tiles(layouts, [Color.RED]), tmp, incremental=True, settings=settings)
+            self.assertEqual([], os.listdir(f'{tmp}/20px'))
+
+    def test_render_key_keeps_position(self):
+        red_top = Corner([top_pt, right_pt], PX_PER_TILE)
+        red_top.set_color(Color.RED)
+        green_bot = Corner([bot_pt, left_pt], PX_PER_TILE)
+        green_bot.set_color(Color.GREEN)
+        green_top = Corner([top_pt, right_pt], PX_PER_TILE)
+        green_top.set_color(Color.GREEN)
+        red_bot = Corner([bot_pt, left_pt], PX_PER_TILE)
+        red_bot.set_color(Color.RED)
+
+        tile1 = PathTile([red_top, green_bot])
+        tile2 = PathTile([green_top, red_bot])
+        # equal as far as the deck is concerned, but they're drawn rotated from one another
+        self.assertEqual(tile1, tile2)
+        self.assertNotEqual(tile1.render_key, tile2.render_key)
+
+
+class TestDrawSheets(TestCase):
+    def _tiles(self):
+        colors = [Color.RED, Color.GREEN]
+        layouts = [(ShapeType.CORNER, ShapeType.CORNER, ShapeType.CORNER, ShapeType.CORNER),
+                   (ShapeType.TEE, ShapeType.TEE, ShapeType.TEE, ShapeType.BLANK)]
+        return list(chain(gen_path_tiles(layouts, colors), gen_novelty_tiles(1, True)))
+
+    def test_regions_match_tiles(self):
+        tiles = self._tiles()
+        with tempfile.TemporaryDirectory() as tmp:
+            draw_tiles(tiles, tmp)
+            sheet_dir = os.path.join(tmp, "sheets")
+            draw_sheets(tiles, sheet_dir, columns=3, rows=2, bleed=6, margin=10, workers=2)
+
+            with open(f'{sheet_dir}/index.json') as f:
+                index = json.load(f)
+            # 4 starters, 3 corner pairs, 2 tees and 3 novelty tiles
+            self.assertEqual(12, len(index["tiles"]))
+            self.assertEqual(["sheet_0.png", "sheet_1.png"], index["sheets"])
+            for tile_id, rect in index["tiles"].items():
+                with Image.open(f'{sheet_dir}/{rect["sheet"]}') as sheet:
+                    region = sheet.crop((rect["x"], rect["y"], rect["x"] + rect["w"], rect["y"] + rect["h"]))
+                with Image.open(f'{tmp}/{tile_id}.png') as tile:
+                    self.assertEqual(tile.tobytes(), region.tobytes(), tile_id)
+
+    def test_bleed_extends_edges(self):
+        tiles = self._tiles()[:1]
+        with tempfile.TemporaryDirectory() as tmp:
+            draw_sheets(tiles, tmp, columns=1, rows=1, bleed=4, margin=2)
+            with Image.open(f'{tmp}/sheet_0.png') as sheet:
+                self.assertEqual((PX_PER_TILE + 12, PX_PER_TILE + 12), sheet.size)
+                self.assertEqual(Color.WHITE.value, sheet.getpixel((0, 0)))
+                # the starter's top nub runs off the edge and into the bleed
+                self.assertEqual(sheet.getpixel((2 + 4 + PX_PER_TILE // 2, 6)),
+                                 sheet.getpixel((2 + 4 + PX_PER_TILE // 2, 2)))
+                self.assertEqual(Color.RED.value, sheet.getpixel((2 + 4 + PX_PER_TILE // 2, 2)))
+
+
+class TestGenerateDecks(TestCase):
+    def test_restricted_alphabet_drops_tees(self):
+        tees_dropped = [shapes for shapes in enumerate_layouts()
+                        if shapes[0] != ShapeType.TEE and shapes[1] != ShapeType.TEE]
+        restricted = enumerate_layouts((ShapeType.CORNER, ShapeType.LINE, ShapeType.BLANK))
+        self.assertEqual(tees_dropped, list(restricted))
+
+    def test_decks_share_renders(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            specs = [
+                DeckSpec(f'{tmp}/a', colors=(Color.RED, Color.GREEN), novelty_count=1),
+                DeckSpec(f'{tmp}/b', colors=(Color.RED,), shape_types=(ShapeType.CORNER, ShapeType.BLANK),
+                         novelty_assets=("star.png",)),
+                DeckSpec(f'{tmp}/c', colors=(Color.RED,), format="sheets", columns=2, rows=2,
+                         novelty_assets=()),
+            ]
+            counts = generate_decks(specs, workers=1)
+            self.assertEqual([counts[spec.out_dir] for spec in specs], [count_tiles(spec) for spec in specs])
+
+            # 4 starters, 3 + 2 corner, 3 + 2 line and 2 tee colorings, and each asset once
+            self.assertEqual(18, counts[f'{tmp}/a'])
+            # 2 starters, 1 corner coloring each for the quad and pair layouts, a star
+            self.assertEqual(5, counts[f'{tmp}/b'])
+            self.assertTrue(os.path.samefile(f'{tmp}/a/0.png', f'{tmp}/b/0.png'))
+            # 2 starters plus a coloring of each of the 5 layouts
+            self.assertEqual(7, counts[f'{tmp}/c'])
+            self.assertEqual(["edges.bin", "index.json", "sheet_0.png", "sheet_1.png"],
+                             sorted(os.listdir(f'{tmp}/c')))
+
+    def test_incremental_decks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            spec = DeckSpec(f'{tmp}/a', colors=(Color.RED, Color.GREEN), settings=RenderSettings(px_per_tile=32))
+            generate_decks([spec], workers=1, incremental=True)
+            mtimes = {name: os.stat(f'{tmp}/a/{name}').st_mtime_ns for name in load_manifest(f'{tmp}/a')}
+
+            # a second build keeps every tile, and dropping a color only redraws what it changed
+            generate_decks([spec], workers=1, incremental=True)
+            self.assertEqual(mtimes, {name: os.stat(f'{tmp}/a/{name}').st_mtime_ns for name in mtimes})
+            generate_decks([replace(spec, colors=(Color.RED,))], workers=1, incremental=True)
+            self.assertEqual(mtimes["0.png"], os.stat(f'{tmp}/a/0.png').st_mtime_ns)
+            self.assertEqual(count_tiles(replace(spec, colors=(Color.RED,))), len(load_manifest(f'{tmp}/a')))
+
+            # without it the deck is cleared and drawn again
+            generate_decks([spec], workers=1)
+            self.assertNotEqual(mtimes["0.png"], os.stat(f'{tmp}/a/0.png').st_mtime_ns)
+
+    def test_enumeration_cache(self):
+        colors = [Color.RED, Color.BLUE]
+        with tempfile.TemporaryDirectory() as tmp:
+            layouts, colorings = deck_enumeration(DEFAULT_SHAPE_TYPES, colors, tmp)
+            self.assertEqual(enumerate_layouts(), layouts)
+            path = f'{tmp}/{enumeration_key(DEFAULT_SHAPE_TYPES, colors)}.json'
+            with open(path) as f:
+                cached = json.load(f)
+
+            # later calls read the file rather than enumerating again
+            cached["colorings"][0] = 99
+            with open(path, "w") as f:
+                json.dump(cached, f)
+            self.assertEqual((layouts, (99,) + colorings[1:]), deck_enumeration(DEFAULT_SHAPE_TYPES, colors, tmp))
+            self.assertNotEqual(enumeration_key(DEFAULT_SHAPE_TYPES, colors[:1]),
+                                enumeration_key(DEFAULT_SHAPE_TYPES, colors))
+
+    def test_counting_skips_pillow(self):
+        code = "import sys, generate_tiles; print(generate_tiles.count_tiles(generate_tiles.DeckSpec('x'))); " \
+               "print('PIL.Image' in sys.modules)"
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual("48\nFalse\n", output)
+
+    def test_spec_from_dict(self):
+        settings = RenderSettings(palette=True)
+        spec = deck_spec_from_dict({"out_dir": "out", "colors": ["red", "PINK"], "shape_types": ["corner"],
+                                    "novelty_assets": ["star.png"], "px_per_tile": 64,
+                                    "compress_type": "rle"}, settings)
+        self.assertEqual(DeckSpec("out", colors=(Color.RED, Color.PINK), shape_types=(ShapeType.CORNER,),
+                                  novelty_assets=("star.png",),
+                                  settings=RenderSettings(64, palette=True, compress_type=zlib.Z_RLE)), spec)
+        with self.assertRaises(KeyError):
+            deck_spec_from_dict({"out_dir": "out", "colors": ["mauve"]})
+        with self.assertRaises(ValueError):
+            deck_spec_from_dict({"out_dir": "out", "format": "pdf"})
+        self.assertEqual((300, 64), deck_spec_from_dict({"out_dir": "out", "px_per_tile": 1200,
+                                                         "sizes": [300, 64]}).sizes)
+        with self.assertRaises(ValueError):
+            deck_spec_from_dict({"out_dir": "out", "format": "sheets", "sizes": [64]})
+
+
+class TestInstrumentation(TestCase):
+    def tearDown(self):
+        instrumentation.enabled = False
+        instrumentation.reset()
+
+    def _build(self):
+        layouts = [(ShapeType.CORNER, ShapeType.CORNER, ShapeType.CORNER, ShapeType.CORNER)]
+        with tempfile.TemporaryDirectory() as tmp:
+            with instrumentation.stage("deck"):
+                draw_tiles(gen_path_tiles(layouts, [Color.RED, Color.GREEN]), tmp)
+
+    def test_disabled_records_nothing(self):
+        instrumentation.reset()
+        self._build()
+        self.assertEqual([], instrumentation.events)
+        self.assertEqual({}, dict(instrumentation.counters))
+        self.assertEqual({}, dict(instrumentation.samples))
+
+    def test_enabled(self):
+        instrumentation.enabled = True
+        instrumentation.reset()
+        self._build()
+
+        # 2 starters twice, plus red/red, red/green and green/green corners
+        self.assertEqual(5, instrumentation.counters["render_cache.misses"])
+        self.assertEqual(2, instrumentation.counters["render_cache.hits"])
+        # 2 colors over 2 corners is 4 candidates for 3 tiles, and each starter's 4 nubs in 1 color
+        # is 1 candidate for 1 tile
+        self.assertEqual(1, instrumentation.counters["generate_colored.duplicates_skipped"])
+        self.assertEqual(5, len(instrumentation.samples["draw"]))
+        self.assertEqual(5, len(instrumentation.samples["encode"]))
+        self.assertEqual(2, len(instrumentation.samples["link"]))
+
+        summary = instrumentation.summary()
+        self.assertIn("deck", summary)
+        self.assertIn("render cache hit rate", summary)
+
+        trace = instrumentation.chrome_trace()
+        names = {e["name"] for e in trace["traceEvents"]}
+        self.assertTrue({"deck", "generate", "draw", "encode", "write"} <= names)
+        for event in trace["traceEvents"]:
+            if event["ph"] == "X":
+                self.assertGreaterEqual(event["dur"], 0)
+
+    def test_worker_cache_rates(self):
+        for cache in (load_font, load_asset, shape_stamp, shape_coverage, label_coverage):
+            cache.cache_clear()
+        instrumentation.enabled = True
+        instrumentation.reset()
+        tiles = list(chain(gen_path_tiles([(ShapeType.CORNER,) * 4], [Color.RED]), gen_novelty_tiles(1, True)))
+        with tempfile.TemporaryDirectory() as tmp:
+            draw_tiles(tiles, tmp, workers=2, settings=RenderSettings(px_per_tile=64))
+
+        # everything was drawn in the workers, so the hits and misses are all ones they sent back
+        self.assertEqual((0, 0), Instrumentation.cache_counts()["stamp"])
+        self.assertGreater(instrumentation.counters["stamp_cache.misses"], 0)
+        self.assertGreater(instrumentation.counters["asset_cache.misses"], 0)
+        rates = instrumentation.cache_rates()
+        self.assertEqual((instrumentation.counters["font_cache.hits"], instrumentation.counters["font_cache.misses"]),
+                         rates["font"])
+        self.assertGreater(sum(rates["font"]), 0)
@@ -0,0 +1,118 @@
+import threading
+import urllib.error
+import urllib.request
+from unittest import TestCase
+
+from preview_server import *
+
+
+class TestPngCache(TestCase):
+    def _render(self, data: bytes):
+        def render():
+            future = Future()
+            future.set_result(data)
+            return future
+        return render
+
+    def test_hits_and_eviction(self):
+        cache = PngCache(max_bytes=10)
+        self.assertEqual(b"aaaa", cache.get("a", self._render(b"aaaa")))
+        self.assertEqual(b"aaaa", cache.get("a", self._render(b"other")))
+        cache.get("b", self._render(b"bbbb"))
+        # a is the most recently used, so b goes
+        cache.get("a", self._render(b"other"))
+        cache.get("c", self._render(b"cccc"))
+        self.assertEqual(["a", "c"], list(cache.entries))
+        self.assertEqual({"entries": 2, "bytes": 8, "hits": 2, "misses": 3}, cache.stats())
+
+
+class TestPreviewServer(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = PreviewServer(("localhost", 0), workers=1)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def _get(self, path: str) -> bytes:
+        with urllib.request.urlopen(f'http://localhost:{self.server.server_port}{path}') as response:
+            return response.read()
+
+    def test_tile_matches_render(self):
+        data = self._get("/tile?layout=corner,corner,blank,blank&colors=red")
+        shapes = [copy.copy(s) for s in TilePattern((ShapeType.CORNER, ShapeType.CORNER, ShapeType.BLANK,
+                                                      ShapeType.BLANK)).shapes]
+        shapes[0].set_color(Color.RED)
+        self.assertEqual(encode_png(render_tile(PathTile(shapes))), data)
+
+        misses = self.server.cache.stats()["misses"]
+        self.assertEqual(data, self._get("/tile?colors=RED&layout=corner,corner,blank,blank"))
+        self.assertEqual(misses, self.server.cache.stats()["misses"])
+
+    def test_line_width(self):
+        data = self._get("/tile?layout=line,line,line,line&colors=red&px=100&line_width_pct=0.2")
+        tile = next(TilePattern((ShapeType.LINE,) * 4).generate_colored([Color.RED]))
+        self.assertEqual(encode_png(render_tile(tile, RenderSettings(px_per_tile=100, line_width_pct=0.2))), data)
+        self.assertNotEqual(self._get("/tile?layout=line,line,line,line&colors=red&px=100"), data)
+
+    def test_tiny_tiles(self):
+        for px in range(1, 6):
+            with Image.open(io.BytesIO(self._get(f'/tile?layout=corner,corner,blank,blank&colors=red&px={px}'))) as im:
+                self.assertEqual((px, px), im.size)
+            with Image.open(io.BytesIO(self._get(f'/novelty?asset=star.png&px={px}'))) as im:
+                self.assertEqual((px, px), im.size)
+
+    def test_novelty_and_sheet(self):
+        with Image.open(io.BytesIO(self._get("/novelty?asset=star.png&px=64"))) as im:
+            self.assertEqual((64, 64), im.size)
+        # 3 colors over 4 corners of 2 kinds is 6 tiles, on 2 rows of 3
+        data = self._get("/sheet?layout=corner,corner,corner,corner&colors=red,green,blue&columns=3&px=50")
+        with Image.open(io.BytesIO(data)) as im:
+            self.assertEqual((150, 100), im.size)
+
+    def test_sheet_columns_clamped(self):
+        _, (_, tiles, columns, _) = sheet_route({"layout": "corner,corner,corner,corner", "colors": "red,green",
+                                                 "columns": "1000000", "px": "20"})
+        self.assertEqual(len(tiles), columns)
+        data = self._get("/sheet?layout=corner,corner,corner,corner&colors=red,green&columns=1000000&px=20")
+        with Image.open(io.BytesIO(data)) as im:
+            self.assertEqual((20 * len(tiles), 20), im.size)
+
+    def test_sheet_colors_deduplicated(self):
+        layout = "corner,corner,corner,corner"
+        key, (_, tiles, _, _) = sheet_route({"layout": layout, "colors": ",".join(["red", "blue"] * 1000)})
+        self.assertEqual(key, sheet_route({"layout": layout, "colors": "red,blue"})[0])
+        self.assertEqual(len(set(tiles)), len(tiles))
+
+    def test_sheet_too_many_tiles_rejected_before_generating(self):
+        from unittest import mock
+
+        # every color over every layout is 140 tiles
+        colors = ",".join(color.name for color in Color)
+        with mock.patch("preview_server.MAX_SHEET_TILES", 100), \
+                mock.patch.object(TilePattern, "generate_colored", side_effect=AssertionError):
+            with self.assertRaises(ValueError):
+                sheet_route({"colors": colors})
+
+    def test_sheet_pixel_budget(self):
+        # every layout in one color is few enough tiles, but not at 4096px each
+        with self.assertRaises(ValueError):
+            sheet_route({"colors": "red", "px": "4096"})
+        with self.assertRaises(urllib.error.HTTPError) as e:
+            self._get("/sheet?colors=red&px=4096&columns=1")
+        self.assertEqual(400, e.exception.code)
+
+    def test_bad_requests(self):
+        for path in ["/tile?layout=corner,blank,blank,blank&colors=red", "/tile?layout=line,line,line,line",
+                     "/tile?layout=line,line,line,line&colors=red,green,blue", "/novelty?asset=../generate_tiles.py",
+                     "/novelty?asset=star.png&px=0", "/tile?layout=corner,corner,blank,blank&colors=red&px=-1",
+                     "/tile?layout=line,line,line,line&colors=red&px=2000&supersample=4",
+                     "/tile?layout=line,line,line,line&colors=red&line_width_pct=0",
+                     "/tile?layout=line,line,line,line&colors=red&line_width_pct=nan",
+                     "/nothing"]:
+            with self.assertRaises(urllib.error.HTTPError) as e:
+                self._get(path)
+            self.assertEqual(404 if path == "/nothing" else 400, e.exception.code, path)
@@ -0,0 +1,115 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+from PIL import Image
+
+from edge_index import EDGE_INDEX_NAME
+from generate_tiles import *
+from tile_archive import *
+
+
+class TestArchiveWriter(TestCase):
+    def test_round_trip(self):
+        red = bytes([255, 0, 0, 255]) * 6
+        blue = bytes([0, 0, 255, 255]) * 6
+        with tempfile.TemporaryDirectory() as tmp:
+            path = f'{tmp}/{ARCHIVE_NAME}'
+            with ArchiveWriter(path) as writer:
+                self.assertEqual(0, writer.add(7, (3, 2), red, key="red"))
+                writer.add(8, (2, 3), pack_pixels(blue, COMPRESSION_ZLIB), COMPRESSION_ZLIB)
+                writer.add(9, (3, 2), None, key="red")
+            self.assertFalse(os.path.exists(path + ".tmp"))
+
+            with TileArchive(path) as archive:
+                self.assertEqual(3, len(archive))
+                self.assertEqual([7, 8, 9], [e.signature for e in archive.entries])
+                self.assertEqual(0, archive.entries[0].offset % ARCHIVE_ALIGNMENT)
+                self.assertEqual(archive.entries[0].offset, archive.entries[2].offset)
+                self.assertEqual(red, bytes(archive.pixels(2)))
+                self.assertEqual(blue, bytes(archive.pixels(1)))
+                self.assertEqual((3, 2, 4), archive.array(1).shape)
+                self.assertEqual((0, 0, 255, 255), archive.image(1).getpixel((1, 2)))
+
+    def test_not_an_archive(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(f'{tmp}/x.bin', "wb") as f:
+                f.write(b"\0" * 64)
+            with self.assertRaises(ValueError):
+                TileArchive(f'{tmp}/x.bin')
+
+    def test_failed_write_leaves_nothing(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaises(RuntimeError):
+                with ArchiveWriter(f'{tmp}/{ARCHIVE_NAME}') as writer:
+                    writer.add(0, (1, 1), b"\0" * 4)
+                    raise RuntimeError
+            self.assertEqual([], os.listdir(tmp))
+
+
+class TestDrawArchive(TestCase):
+    def _tiles(self) -> List[Tile]:
+        layouts = enumerate_layouts()[:6]
+        return list(chain(gen_path_tiles(layouts, [Color.RED, Color.BLUE]), gen_asset_tiles(["star.png"], 2)))
+
+    def _check_against_png(self, compression: str, workers: int,
+                           settings: RenderSettings = RenderSettings(px_per_tile=64)):
+        tiles = self._tiles()
+        with tempfile.TemporaryDirectory() as tmp:
+            draw_tiles(tiles, f'{tmp}/png', settings=settings)
+            self.assertEqual(len(tiles), draw_archive(tiles, f'{tmp}/archive', workers, settings, compression))
+            with TileArchive(f'{tmp}/archive/{ARCHIVE_NAME}') as archive:
+                self.assertEqual(len(tiles), len(archive))
+                for i, tile in enumerate(tiles):
+                    self.assertEqual(signature_digest(tile), archive.entries[i].signature)
+                    with Image.open(f'{tmp}/png/{i}.png') as png:
+                        np.testing.assert_array_equal(np.asarray(png.convert('RGBA')), archive.array(i))
+                        self.assertEqual(png.convert('RGBA').tobytes(), archive.image(i).tobytes())
+                # the two copies of the star share their pixels
+                self.assertEqual(archive.entries[-1].offset, archive.entries[-2].offset)
+
+    def test_raw_matches_png(self):
+        self._check_against_png("raw", 1)
+
+    def test_zlib_matches_png(self):
+        self._check_against_png("zlib", 2)
+
+    def test_strips_match_png(self):
+        self._check_against_png("raw", 1, RenderSettings(px_per_tile=48, supersample=3, strip_px=16))
+
+    def test_no_workers_rejected(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            write_file(f'{tmp}/keep', b"")
+            with self.assertRaises(ValueError):
+                draw_archive(self._tiles(), tmp, workers=0)
+            with self.assertRaises(ValueError):
+                draw_archive(self._tiles(), tmp, batch_size=0)
+            # turned down before out_dir was cleared
+            self.assertEqual(["keep"], os.listdir(tmp))
+
+    def test_raw_arrays_are_views(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            draw_archive(self._tiles()[:1], tmp, settings=RenderSettings(px_per_tile=16))
+            with TileArchive(f'{tmp}/{ARCHIVE_NAME}') as archive:
+                pixels = archive.array(0)
+                self.assertFalse(pixels.flags.owndata)
+                self.assertFalse(pixels.flags.writeable)
+                del pixels
+
+    def test_signature_digest(self):
+        tiles = list(TilePattern((ShapeType.CORNER,) * 4).generate_colored([Color.RED, Color.BLUE]))
+        # equal tiles share a digest, whichever process works it out
+        self.assertEqual(len(set(tiles)), len({signature_digest(t) for t in tiles}))
+        self.assertNotEqual(signature_digest(NoveltyTile("assets/star.png")),
+                            signature_digest(NoveltyTile("assets/flip.png")))
+
+    def test_archive_deck(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            spec = DeckSpec(f'{tmp}/a', colors=(Color.RED,), format="archive", archive_compression="zlib",
+                            settings=RenderSettings(px_per_tile=32))
+            counts = generate_decks([spec], workers=1)
+            self.assertEqual(count_tiles(spec), counts[spec.out_dir])
+            self.assertEqual(sorted([ARCHIVE_NAME, EDGE_INDEX_NAME]), sorted(os.listdir(spec.out_dir)))
+            with TileArchive(f'{spec.out_dir}/{ARCHIVE_NAME}') as archive:
+                self.assertEqual(counts[spec.out_dir], len(archive))
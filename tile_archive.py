@@ -0,0 +1,151 @@
+# A deck in a single file, for clients that would rather map one file than open and decode a PNG per
+# tile. generate_tiles writes it with draw_archive (format "archive" in a deck spec) and this module reads
+# it back without needing anything from generate_tiles:
+#   with TileArchive("tilesA/tiles.bin") as archive:
+#       pixels = archive.array(12)   # (height, width, 4) uint8, a view straight into the file
+#       image = archive.image(12)    # the same pixels as an RGBA Image
+# All little endian, the file starts with a header of magic, version, tile count and the offset of the
+# index ("<4sHIQ"), followed by each tile's pixels, stored as raw RGBA rows or zlib compressed. Raw pixels
+# start on an ARCHIVE_ALIGNMENT boundary. The index comes last so tiles can be written as they're drawn,
+# one ARCHIVE_ENTRY per tile in tile id order. Tiles with identical images share their stored pixels.
+import mmap
+import os
+import struct
+import zlib
+from dataclasses import dataclass
+from typing import Iterator, Tuple
+
+ARCHIVE_NAME = "tiles.bin"
+ARCHIVE_MAGIC = b"TARC"
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER = "<4sHIQ"
+# tile id, signature, offset, stored length, width, height, compression
+ARCHIVE_ENTRY = "<IQQIHHB3x"
+ARCHIVE_ALIGNMENT = 64
+
+COMPRESSION_RAW = 0
+COMPRESSION_ZLIB = 1
+COMPRESSIONS = {"raw": COMPRESSION_RAW, "zlib": COMPRESSION_ZLIB}
+
+
+@dataclass(frozen=True)
+class ArchiveEntry:
+    tile_id: int
+    signature: int
+    offset: int
+    length: int
+    width: int
+    height: int
+    compression: int
+
+
+def pack_pixels(pixels: bytes, compression: int, level: int = 1) -> bytes:
+    # done by whoever draws the tile, so compression happens in parallel when drawing does
+    if compression == COMPRESSION_ZLIB:
+        return zlib.compress(pixels, level)
+    if compression != COMPRESSION_RAW:
+        raise ValueError(f'unknown compression {compression}')
+    return pixels
+
+
+class ArchiveWriter:
+    # Appends tiles to an archive in tile id order; the index and header are written by close(). A
+    # tile added with the key of an earlier one points at its pixels rather than storing them again.
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp = path + ".tmp"
+        self.file = open(self.tmp, "wb")
+        self.file.write(b"\0" * struct.calcsize(ARCHIVE_HEADER))
+        self.entries = []
+        self.stored = {}
+
+    def add(self, signature: int, size: Tuple[int, int], data: bytes, compression: int = COMPRESSION_RAW,
+            key=None) -> int:
+        # data is the tile's pixels as pack_pixels left them (or None for a key already added), size its
+        # width and height
+        stored = self.stored.get(key) if key is not None else None
+        if stored is None:
+            if compression == COMPRESSION_RAW:
+                self.file.write(b"\0" * (-self.file.tell() % ARCHIVE_ALIGNMENT))
+            stored = (self.file.tell(), len(data), compression)
+            self.file.write(data)
+            if key is not None:
+                self.stored[key] = stored
+        offset, length, compression = stored
+        tile_id = len(self.entries)
+        self.entries.append(ArchiveEntry(tile_id, signature, offset, length, size[0], size[1], compression))
+        return tile_id
+
+    def close(self):
+        index_offset = self.file.tell()
+        for e in self.entries:
+            self.file.write(struct.pack(ARCHIVE_ENTRY, e.tile_id, e.signature, e.offset, e.length, e.width,
+                                        e.height, e.compression))
+        self.file.seek(0)
+        self.file.write(struct.pack(ARCHIVE_HEADER, ARCHIVE_MAGIC, ARCHIVE_VERSION, len(self.entries),
+                                    index_offset))
+        self.file.close()
+        # only replaces an earlier archive once this one is complete
+        os.replace(self.tmp, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.tmp)
+
+
+class TileArchive:
+    # Maps an archive and hands out its tiles. Raw tiles come back as views of the mapping, so nothing
+    # is copied or decoded until the pixels are read; zlib tiles are decompressed on each call. Views
+    # must be dropped before the archive is closed.
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, index_offset = struct.unpack_from(ARCHIVE_HEADER, self.map)
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            self.close()
+            raise ValueError(f'{path} isn\'t a version {ARCHIVE_VERSION} tile archive')
+        entry_size = struct.calcsize(ARCHIVE_ENTRY)
+        self.entries = [ArchiveEntry(*fields) for fields in struct.iter_unpack(
+            ARCHIVE_ENTRY, self.map[index_offset:index_offset + count * entry_size])]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def pixels(self, tile_id: int) -> memoryview:
+        # the tile's RGBA rows, top first
+        e = self.entries[tile_id]
+        data = memoryview(self.map)[e.offset:e.offset + e.length]
+        if e.compression == COMPRESSION_ZLIB:
+            return memoryview(zlib.decompress(data))
+        return data
+
+    def array(self, tile_id: int):
+        import numpy as np
+
+        e = self.entries[tile_id]
+        return np.frombuffer(self.pixels(tile_id), dtype=np.uint8).reshape(e.height, e.width, 4)
+
+    def image(self, tile_id: int):
+        from PIL import Image
+
+        e = self.entries[tile_id]
+        return Image.frombuffer('RGBA', (e.width, e.height), self.pixels(tile_id), 'raw', 'RGBA', 0, 1)
+
+    def arrays(self) -> Iterator:
+        return (self.array(tile_id) for tile_id in range(len(self)))
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()